@@ -1,16 +1,30 @@
 """
 This is the "example" module.
 
-The example module supplies one function, factorial().  For example,
+The example module supplies factorial() and a few companions for
+repeated combinatorics: cached_factorial(), factorials(), binomial() and
+the modular ModularFactorials table.  For example,
 
 >>> factorial(5)
 120
+>>> binomial(10, 3)
+120
 """
 
+import math
+from bisect import bisect_right
+from collections import OrderedDict
+
+from primes import primes
 
-def factorial(n):
+
+def factorial(n, method='swing'):
     """Return the factorial of n, an exact integer >= 0.
 
+    *method* picks the algorithm: 'swing' (the default) uses Luschny's
+    prime-swing recursion over a product tree, 'loop' multiplies 2..n
+    one at a time.
+
     >>> [factorial(n) for n in range(6)]
     [1, 1, 2, 6, 24, 120]
     >>> factorial(30)
@@ -33,6 +47,14 @@ def factorial(n):
     Traceback (most recent call last):
         ...
     OverflowError: n too large
+
+    Both methods agree:
+    >>> factorial(200) == factorial(200, method='loop')
+    True
+    >>> factorial(5, method='gamma')
+    Traceback (most recent call last):
+        ...
+    ValueError: unknown method 'gamma'
     """
 
     import math
@@ -42,6 +64,10 @@ def factorial(n):
         raise ValueError("n must be exact integer")
     if n+1 == n:  # catch a value like 1e300
         raise OverflowError("n too large")
+    if method == 'swing':
+        return _swing_factorial(int(n))
+    if method != 'loop':
+        raise ValueError("unknown method {!r}".format(method))
     result = 1
     factor = 2
     while factor <= n:
@@ -50,6 +76,262 @@ def factorial(n):
     return result
 
 
+def product(factors, lo=0, hi=None):
+    """Return the product of factors[lo:hi] by binary splitting.
+
+    Splitting in halves keeps both operands of each multiplication about
+    the same size, which is what lets big-int multiplication pay off.
+
+    >>> product([2, 3, 5, 7])
+    210
+    >>> product([])
+    1
+    """
+    if hi is None:
+        hi = len(factors)
+    if hi - lo <= 8:
+        result = 1
+        for i in range(lo, hi):
+            result *= factors[i]
+        return result
+    mid = (lo + hi) // 2
+    return product(factors, lo, mid) * product(factors, mid, hi)
+
+
+def _swing_factorial(n):
+    """Return n! as odd(n!) shifted left by the exponent of 2 in n!."""
+    if n < 2:
+        return 1
+    odd_primes = primes(n)[1:]
+    return _odd_factorial(n, odd_primes) << (n - bin(n).count('1'))
+
+
+def _odd_factorial(n, odd_primes):
+    """Return the odd part of n! as odd(n//2)!**2 * odd swing(n)."""
+    if n < 2:
+        return 1
+    half = _odd_factorial(n // 2, odd_primes)
+    return half * half * _swing(n, odd_primes)
+
+
+def _swing(n, odd_primes):
+    """Return the odd part of n! / ((n//2)!)**2 from its prime powers."""
+    factors = []
+    for p in odd_primes:
+        if p > n:
+            break
+        q = n
+        power = 1
+        while q >= p:
+            q //= p
+            if q & 1:
+                power *= p
+        if power > 1:
+            factors.append(power)
+    return product(factors)
+
+
+class FactorialCache:
+    """Bounded LRU cache of checkpoint factorials.
+
+    A lookup multiplies up from the nearest cached n' <= n instead of
+    starting over, and the result becomes a new checkpoint.  When no
+    checkpoint is close enough the prime swing is used instead.
+
+    >>> cache = FactorialCache(maxsize=2)
+    >>> cache(10), cache(12), len(cache)
+    (3628800, 479001600, 2)
+    """
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self._values = OrderedDict()
+        self._keys = []
+
+    def __len__(self):
+        return len(self._values)
+
+    def __call__(self, n):
+        n = _checked(n)
+        values = self._values
+        if n in values:
+            values.move_to_end(n)
+            return values[n]
+
+        i = bisect_right(self._keys, n)
+        nearest = self._keys[i - 1] if i else 0
+        if nearest and n - nearest < n // 2:
+            result = values[nearest] * product(range(nearest + 1, n + 1))
+            values.move_to_end(nearest)
+        else:
+            result = _swing_factorial(n)
+
+        values[n] = result
+        self._keys.insert(i, n)
+        if len(values) > self.maxsize:
+            oldest, _ = values.popitem(last=False)
+            del self._keys[bisect_right(self._keys, oldest) - 1]
+        return result
+
+
+cached_factorial = FactorialCache()
+
+
+def factorials(ns):
+    """Return [n! for n in ns], computing each from the next smaller one.
+
+    >>> factorials([5, 3, 5, 0])
+    [120, 6, 120, 1]
+    """
+    ns = [_checked(n) for n in ns]
+    results = {}
+    previous, value = 0, 1
+    for n in sorted(set(ns)):
+        if n - previous < n // 2:
+            value *= product(range(previous + 1, n + 1))
+        else:
+            value = _swing_factorial(n)
+        results[n] = value
+        previous = n
+    return [results[n] for n in ns]
+
+
+# binomial() sieves up to n only when min(k, n - k) is above
+# n / BINOMIAL_SIEVE_RATIO; for smaller k math.comb() is faster and
+# needs no O(n) table of primes.
+BINOMIAL_SIEVE_RATIO = 64
+
+
+def binomial(n, k):
+    """Return the binomial coefficient C(n, k) from its prime factorization.
+
+    The exponent of each prime p is the number of carries when adding k
+    and n - k in base p (Kummer's theorem), so no factorial is formed.
+    For small min(k, n - k) this hands over to math.comb() instead.
+
+    >>> [binomial(6, k) for k in range(7)]
+    [1, 6, 15, 20, 15, 6, 1]
+    >>> binomial(5, 7)
+    0
+    """
+    n = _checked(n)
+    k = _checked(k)
+    if k > n:
+        return 0
+    k = min(k, n - k)
+    if k * BINOMIAL_SIEVE_RATIO <= n:
+        return math.comb(n, k)
+    factors = []
+    for p in primes(n):
+        if p > n - k:
+            factors.append(p)
+            continue
+        power = 1
+        a, b, carry = k, n - k, 0
+        while a or b or carry:
+            carry = (a % p + b % p + carry) >= p
+            if carry:
+                power *= p
+            a //= p
+            b //= p
+        if power > 1:
+            factors.append(power)
+    return product(factors)
+
+
+def factorial_mod(n, p):
+    """Return n! mod p for a prime p.
+
+    Past p/2 it divides -1 = (p-1)! mod p (Wilson's theorem) by the
+    shorter product (n+1)...(p-1).
+
+    >>> factorial_mod(10, 13), factorial(10) % 13
+    (6, 6)
+    >>> factorial_mod(20, 13)
+    0
+    """
+    n = _checked(n)
+    if n >= p:
+        return 0
+    if n < p // 2:
+        result = 1
+        for i in range(2, n + 1):
+            result = result * i % p
+        return result
+    denominator = 1
+    for i in range(n + 1, p):
+        denominator = denominator * i % p
+    return (p - 1) * pow(denominator, -1, p) % p
+
+
+class ModularFactorials:
+    """Factorial and inverse-factorial tables mod a prime p.
+
+    Built once in O(limit), after which factorial(), inverse() and
+    binomial() answer in O(1) for arguments up to *limit*.
+
+    >>> table = ModularFactorials(10**9 + 7, 1000)
+    >>> table.binomial(1000, 500) == binomial(1000, 500) % (10**9 + 7)
+    True
+    """
+
+    def __init__(self, p, limit):
+        limit = min(limit, p - 1)
+        fact = [1] * (limit + 1)
+        for i in range(2, limit + 1):
+            fact[i] = fact[i - 1] * i % p
+        inv = [1] * (limit + 1)
+        inv[limit] = pow(fact[limit], -1, p)
+        for i in range(limit, 1, -1):
+            inv[i - 1] = inv[i] * i % p
+        self.p = p
+        self.limit = limit
+        self._fact = fact
+        self._inv = inv
+
+    def factorial(self, n):
+        """Return n! mod p."""
+        if n >= self.p:
+            return 0
+        return self._fact[n]
+
+    def inverse(self, n):
+        """Return the inverse of n! mod p, for n < p."""
+        return self._inv[n]
+
+    def binomial(self, n, k):
+        """Return C(n, k) mod p, using Lucas' theorem for n >= p.
+
+        Arguments past *limit* need a table built with limit >= p - 1.
+
+        >>> ModularFactorials(7, 6).binomial(10, 3) == binomial(10, 3) % 7
+        True
+        """
+        if k < 0 or k > n:
+            return 0
+        p = self.p
+        result = 1
+        while n or k:
+            a, b = n % p, k % p
+            if b > a:
+                return 0
+            result = result * self._fact[a] * self._inv[b] * self._inv[a - b] % p
+            n //= p
+            k //= p
+        return result
+
+
+def _checked(n):
+    """Validate n as factorial() does and return it as an int."""
+    if not n >= 0:
+        raise ValueError("n must be >= 0")
+    if int(n) != n:
+        raise ValueError("n must be exact integer")
+    if n+1 == n:  # catch a value like 1e300
+        raise OverflowError("n too large")
+    return int(n)
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
@@ -0,0 +1,45 @@
+"""Benchmark factorial() against math.factorial and the plain loop.
+
+Usage: python factorial_bench.py [n ...]
+"""
+
+import math
+import sys
+import time
+
+from factorial import factorial
+
+# Above this the 'loop' method takes minutes and is skipped.
+LOOP_LIMIT = 2 * 10**5
+
+
+def best_time(func, n, repeat=3):
+    """Return the best wall-clock time of func(n) over *repeat* runs."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(n)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(sizes):
+    contenders = [
+        ('math.factorial', math.factorial),
+        ('swing', factorial),
+        ('loop', lambda n: factorial(n, method='loop')),
+    ]
+    print('{:>10} {:>16} {:>12} {:>12}'.format('n', *[c[0] for c in contenders]))
+    for n in sizes:
+        timings = []
+        for name, func in contenders:
+            if name == 'loop' and n > LOOP_LIMIT:
+                timings.append('skipped')
+            else:
+                repeat = 1 if n >= 10**5 else 3
+                timings.append('{:.4f}s'.format(best_time(func, n, repeat)))
+        print('{:>10} {:>16} {:>12} {:>12}'.format(n, *timings))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10**3, 10**4, 10**5, 10**6])
@@ -0,0 +1,175 @@
+"""Integer factorization for single numbers and whole batches
+
+>>> factorize(360)
+[2, 2, 2, 3, 3, 5]
+>>> factorize_many([1, 12, 97, 2**64 + 1])
+[[], [2, 2, 3], [97], [274177, 67280421310721]]
+"""
+
+from array import array
+from math import gcd, isqrt
+
+from primes import primes
+from prime_table import miller_rabin
+
+# Numbers up to this bound are factored from the smallest-prime-factor
+# table; larger ones go through trial division and Pollard's rho.
+SPF_THRESHOLD = 2**20
+
+# Primes tried by plain division before falling back to Pollard's rho.
+SMALL_PRIMES = primes(1000)
+
+
+def spf_table(limit):
+    """Return an array whose entry n is the smallest prime factor of n.
+
+    Entries for 0, 1 and for primes are 0, which keeps the table a single
+    slice-assignment pass per base prime: primes are visited from largest
+    to smallest so the smallest factor is written last.
+
+    >>> list(spf_table(12))
+    [0, 0, 0, 0, 2, 0, 2, 0, 2, 3, 2, 0, 2]
+    """
+    spf = array('I', bytes(4 * (limit + 1)))
+    for p in reversed(primes(isqrt(limit))):
+        start = p * p
+        spf[start::p] = array('I', [p]) * len(range(start, limit + 1, p))
+    return spf
+
+
+def pollard_brent(n):
+    """Return a non-trivial factor of the odd composite n.
+
+    Pollard's rho with Brent's cycle detection, batching the gcd over
+    runs of 128 steps.
+
+    >>> pollard_brent(8051) in (83, 97)
+    True
+    """
+    c = 1
+    while True:
+        y, r, q = 2, 1, 1
+        g = 1
+        while g == 1:
+            x = y
+            for _ in range(r):
+                y = (y * y + c) % n
+            k = 0
+            while k < r and g == 1:
+                ys = y
+                for _ in range(min(128, r - k)):
+                    y = (y * y + c) % n
+                    q = q * abs(x - y) % n
+                g = gcd(q, n)
+                k += 128
+            r *= 2
+        if g == n:
+            g = 1
+            while g == 1:
+                ys = (ys * ys + c) % n
+                g = gcd(abs(x - ys), n)
+        if g != n:
+            return g
+        c += 1
+
+
+class Factorizer:
+    """Factor integers using a smallest-prime-factor table built once.
+
+    Numbers <= threshold are factored in O(log n) table lookups; larger
+    ones use trial division by SMALL_PRIMES, then miller_rabin() and
+    pollard_brent().
+    """
+
+    def __init__(self, threshold=SPF_THRESHOLD):
+        self.threshold = threshold
+        self._spf = spf_table(threshold)
+
+    def factorize(self, n):
+        """Return the prime factors of n in increasing order.
+
+        >>> Factorizer(100).factorize(9991)
+        [97, 103]
+        >>> Factorizer(100).factorize(0)
+        Traceback (most recent call last):
+            ...
+        ValueError: n must be >= 1
+        """
+        n = int(n)
+        if n < 1:
+            raise ValueError("n must be >= 1")
+        if n <= self.threshold:
+            return self._factor_small(n)
+
+        factors = []
+        for p in SMALL_PRIMES:
+            if p * p > n:
+                break
+            while n % p == 0:
+                factors.append(p)
+                n //= p
+        if n <= self.threshold:
+            factors += self._factor_small(n)
+        else:
+            self._factor_large(n, factors)
+        factors.sort()
+        return factors
+
+    def factorize_many(self, values):
+        """Return a list of factor lists, one per number in *values*.
+
+        *values* can be any iterable of integers, including a NumPy array.
+
+        >>> Factorizer(50).factorize_many(range(1, 7))
+        [[], [2], [3], [2, 2], [5], [2, 3]]
+        """
+        factorize = self.factorize
+        return [factorize(n) for n in values]
+
+    def _factor_small(self, n):
+        spf = self._spf
+        factors = []
+        while n > 1:
+            p = spf[n] or n
+            factors.append(p)
+            n //= p
+        return factors
+
+    def _factor_large(self, n, factors):
+        stack = [n]
+        while stack:
+            n = stack.pop()
+            if n == 1:
+                continue
+            if n <= self.threshold:
+                factors += self._factor_small(n)
+            elif miller_rabin(n):
+                factors.append(n)
+            else:
+                d = pollard_brent(n)
+                stack += [d, n // d]
+
+
+_default = None
+
+
+def _default_factorizer():
+    global _default
+    if _default is None:
+        _default = Factorizer()
+    return _default
+
+
+def factorize(n):
+    """Return the prime factors of n using a shared Factorizer."""
+    return _default_factorizer().factorize(n)
+
+
+def factorize_many(values):
+    """Factor every number in *values* using a shared Factorizer."""
+    return _default_factorizer().factorize_many(values)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,161 @@
+"""Cached prime table for repeated primality and prime-count queries
+
+>>> table = PrimeTable(100)
+>>> table.is_prime(97), table.pi(100), table.nth_prime(25), table.next_prime(100)
+(True, 25, 97, 101)
+"""
+
+from array import array
+from bisect import bisect_right
+from itertools import compress
+from math import isqrt, log
+
+from primes import primes, sieve_odd, sieve_segment
+
+# Witnesses that make miller_rabin() exact for every n below
+# 3317044064679887385961981.
+MR_BASES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41)
+
+
+def miller_rabin(n):
+    """Return True if n is prime, using Miller-Rabin over MR_BASES.
+
+    The answer is exact for n < 3.3 * 10**24 and a strong probable-prime
+    test above that.
+
+    >>> [n for n in range(30) if miller_rabin(n)]
+    [2, 3, 5, 7, 11, 13, 17, 19, 23, 29]
+    >>> miller_rabin(2**61 - 1), miller_rabin(3215031751)
+    (True, False)
+    """
+    if n < 2:
+        return False
+    for p in MR_BASES:
+        if n % p == 0:
+            return n == p
+    d = n - 1
+    s = 0
+    while not d & 1:
+        d >>= 1
+        s += 1
+    for a in MR_BASES:
+        x = pow(a, d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for _ in range(s - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+class PrimeTable:
+    """Sieve once and answer prime queries from the cached result.
+
+    The table keeps an odd-only sieve for O(1) is_prime() and a compact
+    array of the primes for O(log n) pi(), nth_prime() and next_prime().
+    Queries past the table either grow it (pi, nth_prime) or fall back
+    to miller_rabin() (is_prime, next_prime).
+    """
+
+    def __init__(self, limit=2**16):
+        self.limit = 0
+        self._sieve = bytearray()
+        self._primes = array('I')
+        self.grow(limit)
+
+    def __len__(self):
+        return len(self._primes)
+
+    def grow(self, limit):
+        """Extend the table so it covers every number <= limit.
+
+        Only the new part of the range is sieved.
+
+        >>> table = PrimeTable(10)
+        >>> table.grow(30)
+        >>> table.limit, len(table)
+        (30, 10)
+        """
+        if limit <= self.limit:
+            return
+        if self.limit < 2:
+            self._sieve = sieve_odd(limit)
+            self._primes = array('I' if limit < 2**32 else 'Q')
+            if limit >= 2:
+                self._primes.append(2)
+            self._primes.extend(compress(range(1, limit + 1, 2), self._sieve))
+        else:
+            if limit >= 2**32 and self._primes.typecode == 'I':
+                self._primes = array('Q', self._primes)
+            first = 2 * len(self._sieve) + 1
+            if first <= limit:
+                base = primes(isqrt(limit))[1:]
+                segment = sieve_segment(first, limit + 1, base)
+                self._sieve += segment
+                self._primes.extend(compress(range(first, limit + 1, 2),
+                                             segment))
+        self.limit = limit
+
+    def is_prime(self, x):
+        """Return True if x is prime.
+
+        >>> table = PrimeTable(50)
+        >>> [x for x in range(20) if table.is_prime(x)]
+        [2, 3, 5, 7, 11, 13, 17, 19]
+        >>> table.is_prime(10**9 + 7)
+        True
+        """
+        if x > self.limit:
+            return miller_rabin(x)
+        if x < 3:
+            return x == 2
+        return x & 1 == 1 and self._sieve[x >> 1] == 1
+
+    def pi(self, x):
+        """Return the number of primes <= x, growing the table if needed.
+
+        >>> PrimeTable(10).pi(1000)
+        168
+        """
+        if x > self.limit:
+            self.grow(max(x, 2 * self.limit))
+        return bisect_right(self._primes, x)
+
+    def nth_prime(self, k):
+        """Return the k-th prime, counting from nth_prime(1) == 2.
+
+        >>> PrimeTable(10).nth_prime(1000)
+        7919
+        """
+        if k < 1:
+            raise ValueError("k must be >= 1")
+        if k > len(self._primes):
+            # Rosser's bound p_k < k (ln k + ln ln k) holds for k >= 6.
+            bound = int(k * (log(k) + log(log(k)))) + 1 if k >= 6 else 13
+            self.grow(max(bound, 2 * self.limit))
+        return self._primes[k - 1]
+
+    def next_prime(self, x):
+        """Return the smallest prime > x.
+
+        >>> table = PrimeTable(100)
+        >>> table.next_prime(1), table.next_prime(13), table.next_prime(10**12)
+        (2, 17, 1000000000039)
+        """
+        i = bisect_right(self._primes, x)
+        if i < len(self._primes):
+            return self._primes[i]
+        candidate = max(x + 1, 2)
+        if candidate > 2 and not candidate & 1:
+            candidate += 1
+        while not miller_rabin(candidate):
+            candidate += 2
+        return candidate
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -1,13 +1,237 @@
-"""Find primes up to n"""
+"""Find primes up to n
+
+>>> primes(30)
+[2, 3, 5, 7, 11, 13, 17, 19, 23, 29]
+>>> list(primes_range(90, 130))
+[97, 101, 103, 107, 109, 113, 127]
+>>> count_primes(0, 10**6, processes=2)
+78498
+"""
+
+from array import array
+from itertools import chain, compress
+from math import isqrt
+from multiprocessing import Pool, cpu_count
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Numbers sieved per segment by primes_range(), sized to stay in L2 cache.
+SEGMENT_SIZE = 1 << 18
 
 
 def primes(n):
-    mroot = int(n**0.5)
-    sieve = list(range(n + 1))
+    """Return the list of primes <= n.
+
+    >>> primes(1)
+    []
+    >>> primes(2)
+    [2]
+    >>> len(primes(10**6))
+    78498
+    """
+    return list(_iter_sieve(n))
+
+
+def primes_array(n, typecode=None):
+    """Return the primes <= n as a compact array.array.
+
+    *typecode* defaults to 'I' when every prime fits in 32 bits and
+    'Q' otherwise.
+
+    >>> primes_array(20)
+    array('I', [2, 3, 5, 7, 11, 13, 17, 19])
+    """
+    if typecode is None:
+        typecode = 'I' if n < 2**32 else 'Q'
+    return array(typecode, _iter_sieve(n))
+
+
+def primes_numpy(n):
+    """Return the primes <= n as a NumPy int64 array (requires numpy)."""
+    if np is None:
+        raise ImportError("primes_numpy() requires numpy")
+    if n < 2:
+        return np.zeros(0, dtype=np.int64)
+    odd = np.frombuffer(sieve_odd(n), dtype=np.uint8)
+    found = np.flatnonzero(odd) * 2 + 1
+    return np.concatenate((np.array([2], dtype=np.int64), found))
+
+
+def sieve_odd(n):
+    """Return an odd-only sieve of the numbers up to n.
 
-    for i in range(2, mroot+1):
+    Byte i of the result is 1 when 2*i + 1 is prime and 0 otherwise, so
+    the table costs one byte per two numbers.  Multiples are cleared with
+    slice assignment, which keeps the inner loop in C.
+
+    >>> list(sieve_odd(15))
+    [0, 1, 1, 1, 0, 1, 1, 0]
+    """
+    if n < 1:
+        return bytearray()
+    size = (n + 1) // 2
+    sieve = bytearray(b'\x01') * size
+    sieve[0] = 0
+    for i in range(1, (isqrt(n) - 1) // 2 + 1):
         if sieve[i]:
-            m = n//i - i
-            sieve[i*i: n+1:i] = [0] * (m + 1)
+            p = 2 * i + 1
+            start = p * p // 2
+            sieve[start::p] = bytes(len(range(start, size, p)))
+    return sieve
+
+
+def _iter_sieve(n):
+    """Iterate over the primes <= n using sieve_odd()."""
+    if n < 2:
+        return iter(())
+    return chain((2,), compress(range(1, n + 1, 2), sieve_odd(n)))
+
+
+def primes_range(lo, hi, segment_size=SEGMENT_SIZE):
+    """Yield the primes p with lo <= p < hi in increasing order.
+
+    The range is sieved one segment of *segment_size* numbers at a time
+    against the base primes up to sqrt(hi), so memory stays bounded by
+    the segment size and sqrt(hi) no matter how wide the range is.
+
+    >>> list(primes_range(0, 20))
+    [2, 3, 5, 7, 11, 13, 17, 19]
+    >>> list(primes_range(10**9, 10**9 + 100, segment_size=16))
+    [1000000007, 1000000009, 1000000021, 1000000033, 1000000087, 1000000093, 1000000097]
+    >>> list(primes_range(20, 10))
+    []
+    """
+    lo = max(lo, 2)
+    if hi <= lo:
+        return
+    if segment_size < 1:
+        raise ValueError("segment_size must be >= 1")
+
+    base = primes(isqrt(hi - 1))[1:]
+    if lo == 2:
+        yield 2
+    for first, seg_hi, sieve in _segments(lo, hi, base, segment_size):
+        yield from compress(range(first, seg_hi, 2), sieve)
+
+
+def _segments(lo, hi, base, segment_size):
+    """Yield (first, seg_hi, sieve) for the odd-only segments of [lo, hi).
+
+    *lo* must be >= 2; the prime 2 is never flagged and is left to the
+    caller.
+    """
+    for seg_lo in range(lo, hi, segment_size):
+        seg_hi = min(seg_lo + segment_size, hi)
+        first = seg_lo | 1
+        yield first, seg_hi, sieve_segment(first, seg_hi, base)
+
+
+def sieve_segment(first, seg_hi, base):
+    """Return an odd-only bytearray flagging the primes in [first, seg_hi).
+
+    *first* must be odd and >= 3, and *base* must hold every odd prime up
+    to sqrt(seg_hi - 1).  Byte i of the result stands for first + 2*i.
+    """
+    size = len(range(first, seg_hi, 2))
+    sieve = bytearray(b'\x01') * size
+    for p in base:
+        start = p * p
+        if start >= seg_hi:
+            break
+        if start < first:
+            start = -(-first // p) * p
+            if not start & 1:
+                start += p
+        start = (start - first) // 2
+        sieve[start::p] = bytes(len(range(start, size, p)))
+    return sieve
+
+
+def parallel_primes(lo, hi, processes=None, segment_size=SEGMENT_SIZE):
+    """Return the list of primes in [lo, hi), sieved in a process pool.
+
+    The range is split into contiguous chunks that worker processes sieve
+    against a base-prime table handed to each worker once; the chunks are
+    merged back in order.
+
+    >>> parallel_primes(90, 130, processes=2, segment_size=8)
+    [97, 101, 103, 107, 109, 113, 127]
+    """
+    return list(chain.from_iterable(
+        _parallel_map('list', lo, hi, processes, segment_size)))
+
+
+def count_primes(lo, hi, processes=None, segment_size=SEGMENT_SIZE):
+    """Return how many primes lie in [lo, hi), counted in a process pool.
+
+    Workers return a single count per chunk instead of the primes.
+
+    >>> count_primes(0, 100, processes=2, segment_size=8)
+    25
+    """
+    return sum(_parallel_map('count', lo, hi, processes, segment_size))
+
+
+def sum_primes(lo, hi, processes=None, segment_size=SEGMENT_SIZE):
+    """Return the sum of the primes in [lo, hi), summed in a process pool.
+
+    >>> sum_primes(0, 100, processes=2, segment_size=8)
+    1060
+    """
+    return sum(_parallel_map('sum', lo, hi, processes, segment_size))
+
+
+# Base primes for the current pool worker, set by _init_worker().
+_worker_base = None
+
+
+def _init_worker(base):
+    global _worker_base
+    _worker_base = base
+
+
+def _reduce_chunk(task):
+    """Sieve one chunk in a worker and reduce it as the task asks."""
+    mode, lo, hi, segment_size = task
+    segments = _segments(lo, hi, _worker_base, segment_size)
+    if mode == 'count':
+        return sum(sieve.count(1) for _, _, sieve in segments)
+    found = chain.from_iterable(compress(range(first, seg_hi, 2), sieve)
+                                for first, seg_hi, sieve in segments)
+    if mode == 'sum':
+        return sum(found)
+    return array('Q', found)
+
+
+def _parallel_map(mode, lo, hi, processes, segment_size):
+    """Yield the per-chunk results of *mode* over [lo, hi) in order."""
+    lo = max(lo, 2)
+    if hi <= lo:
+        return
+    if segment_size < 1:
+        raise ValueError("segment_size must be >= 1")
+    if lo == 2:
+        yield {'list': [2], 'count': 1, 'sum': 2}[mode]
+        lo = 3
+        if hi <= lo:
+            return
+
+    processes = processes or cpu_count()
+    # A few chunks per process keeps the pool busy when chunks finish
+    # unevenly; each chunk is a whole number of segments.
+    chunks = max(1, -(-(hi - lo) // segment_size) // (processes * 4))
+    step = chunks * segment_size
+    tasks = [(mode, start, min(start + step, hi), segment_size)
+             for start in range(lo, hi, step)]
+    base = array('Q', primes(isqrt(hi - 1))[1:])
+
+    with Pool(processes, initializer=_init_worker, initargs=(base,)) as pool:
+        yield from pool.imap(_reduce_chunk, tasks)
+
 
-    return [i for i in sieve[2:] if sieve[i]]
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -2,33 +2,348 @@
 symlinks. If any broken symlinks are found print out a report.
 If none are found print out OK.
 
+With --snapshot FILE the directory mtimes and links seen are kept in
+FILE, and the next run only lists the directories that changed since.
+
 """
+import argparse
+import errno
+import functools
+import json
 import os
+import time
+from fnmatch import fnmatch
+
+from link_resolver import BROKEN, LOOP, OK, LinkResolver
+from parallel_hash import DEFAULT_WORKERS
+from scan_tree import walk_dirs
+
+# Glob patterns of entries never looked at; patterns containing a path
+# separator are matched against the whole path, others against the name.
+EXCLUDE = ('.git',)
+
+SNAPSHOT_VERSION = 1
+
+# Directories modified this close to the previous scan are listed again:
+# with coarse timestamps a change made during that scan can leave the
+# mtime it recorded unchanged.
+MTIME_SLACK_NS = 10 ** 9
+
+
+def is_excluded(path, exclude):
+    name = os.path.basename(path)
+    return any(fnmatch(path if os.sep in pattern else name, pattern)
+               for pattern in exclude)
+
+
+def link_status(path, resolver=None):
+    """Return OK, BROKEN or LOOP for the symlink at path.
+
+    By default this is one os.stat() of the target: the kernel's lookup
+    is already cached, and it reports loops and over-long chains as
+    ELOOP. A link_resolver.LinkResolver instead follows the links itself
+    and shares each directory and hop across links, which saves round
+    trips on network filesystems.
+    """
+    if resolver is not None:
+        return resolver.link_status(path)
+    try:
+        os.stat(path)
+    except OSError as e:
+        return LOOP if e.errno == errno.ELOOP else BROKEN
+    return OK
+
+
+def _list_links(path, exclude=EXCLUDE, resolver=None):
+    """List one directory for find_links().
+
+    Returns ((links, broken, loops), subdirs). Whether an entry is a
+    symlink comes from the cached d_type and the link is then checked
+    with link_status(). Links to directories are checked like any other
+    link but not followed.
+    """
+    links = []
+    broken = []
+    loops = []
+    subdirs = []
+    try:
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+    except OSError:
+        return (links, broken, loops), subdirs
+    for entry in entries:
+        if exclude and is_excluded(entry.path, exclude):
+            continue
+        if entry.is_symlink():
+            links.append(entry.path)
+            status = link_status(entry.path, resolver)
+            if status == BROKEN:
+                broken.append(entry.path)
+            elif status == LOOP:
+                loops.append(entry.path)
+        elif entry.is_dir(follow_symlinks=False):
+            subdirs.append(entry.path)
+    return (links, broken, loops), subdirs
 
 
-def find_links(folder):
+def find_links(folder, exclude=EXCLUDE, workers=1, resolver=None):
+    """Return (links, broken, loops) for the symlinks under folder.
+
+    links holds every symlink, broken the ones whose target is missing
+    and loops the ones that never resolve, through a cycle or a chain
+    too long to follow. Directories are listed breadth-first, workers at
+    a time, and entries matching the exclude globs are skipped along
+    with their subtrees. See link_status() for resolver.
+    """
     links = []
     broken = []
-    for root, dirs, files in os.walk(folder):
-        if root.startswith(('./.git', '.', '..')):
-            # Ignore the .git directory.
+    loops = []
+    list_dir = functools.partial(_list_links, exclude=tuple(exclude),
+                                 resolver=resolver)
+    for dir_links, dir_broken, dir_loops in walk_dirs([folder], list_dir,
+                                                      workers):
+        links.extend(dir_links)
+        broken.extend(dir_broken)
+        loops.extend(dir_loops)
+    return links, broken, loops
+
+
+class RescanStats:
+    """Counters filled in by rescan_links()."""
+
+    def __init__(self):
+        self.dirs_listed = 0
+        self.dirs_reused = 0
+        self.links_checked = 0
+        self.links_reused = 0
+
+    def __repr__(self):
+        return ('RescanStats(dirs_listed={}, dirs_reused={}, '
+                'links_checked={}, links_reused={})'.format(
+                    self.dirs_listed, self.dirs_reused, self.links_checked,
+                    self.links_reused))
+
+
+def load_snapshot(path, root, exclude):
+    """Return the snapshot at path, or None when it can't be used for root.
+
+    A snapshot taken of another root or with other excludes, or in an
+    older format, is ignored, so the next scan is a full one.
+    """
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if (snapshot.get('version') != SNAPSHOT_VERSION
+            or snapshot.get('root') != root
+            or snapshot.get('exclude') != list(exclude)):
+        return None
+    return snapshot
+
+
+def save_snapshot(path, snapshot):
+    """Write snapshot to path, replacing the old one atomically."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, path)
+
+
+def _rescan_dir(path, old_dirs, trusted_before, exclude=EXCLUDE,
+                resolver=None):
+    """List one directory for rescan_links(), unless the snapshot has it.
+
+    Returns ((path, record, listed), subdirs). record holds the mtime,
+    subdirs and [link, target, status] entries of the directory; when
+    its mtime is the one recorded it comes from old_dirs without listing
+    the directory or checking its links.
+    """
+    try:
+        mtime = os.stat(path, follow_symlinks=False).st_mtime_ns
+    except OSError:
+        return (path, None, True), []
+    old = old_dirs.get(path)
+    if old is not None and old['mtime'] == mtime < trusted_before:
+        return (path, old, False), old['subdirs']
+    links = []
+    subdirs = []
+    try:
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+    except OSError:
+        entries = []
+    for entry in entries:
+        if exclude and is_excluded(entry.path, exclude):
             continue
-        for filename in files:
-            path = os.path.join(root, filename)
-            if os.path.islink(path):
-                target_path = os.readlink(path)
-                # Resolve relative symlinks
-                if not os.path.isabs(target_path):
-                    target_path = os.path.join(os.path.dirname(path), target_path)
-                if not os.path.exists(target_path):
-                    links.append(path)
-                    broken.append(path)
-                else:
-                    links.append(path)
+        if entry.is_symlink():
+            try:
+                target = os.readlink(entry.path)
+            except OSError:
+                target = None
+            links.append([entry.path, target,
+                          link_status(entry.path, resolver)])
+        elif entry.is_dir(follow_symlinks=False):
+            subdirs.append(entry.path)
+    record = {'mtime': mtime, 'subdirs': subdirs, 'links': links}
+    return (path, record, True), subdirs
+
+
+def _follow(base, target, root):
+    """Return the path target names from directory base, None if unsure.
+
+    That is when the target leaves root or has x/.. in it, which depends
+    on what x resolves to and not just on its name.
+    """
+    if os.pardir in target:
+        named = False
+        for part in target.split(os.sep):
+            if part == os.pardir and named:
+                return None
+            named = named or part not in ('', os.curdir, os.pardir)
+    path = os.path.normpath(os.path.join(base, target))
+    if path != root and not path.startswith(root.rstrip(os.sep) + os.sep):
+        return None
+    return path
+
+
+class _TargetCheck:
+    """Tells whether a link's status may differ from the recorded one.
+
+    Targets are followed by name through the directories and links this
+    scan knows. A status can't have changed if every directory on the
+    way was walked and kept its mtime: names only come and go with the
+    mtime of their directory, and links in unchanged directories still
+    point where they did. Anything else (targets outside root, excluded
+    names, directories that were not walked) is checked again. Directory
+    lookups are memoized, so links sharing a prefix or a hop share the
+    work.
+    """
+
+    def __init__(self, root, exclude, dirs, changed, targets):
+        self.root = root
+        self.exclude = exclude
+        self.targets = targets
+        # Walked directories that kept their mtime.
+        self._stable = dirs - changed
+        self._real_dirs = {}
+
+    def __call__(self, link):
+        seen = set()
+        base = os.path.dirname(link)
+        target = self.targets[link]
+        while target is not None and link not in seen:
+            seen.add(link)
+            path = _follow(base, target, self.root)
+            if path is None:
+                return True
+            if path == self.root:
+                return False
+            parent, name = os.path.split(path)
+            base = self._real_dir(parent)
+            if base is None:
+                return True
+            link = os.path.join(base, name)
+            if self.exclude and is_excluded(link, self.exclude):
+                return True
+            if link not in self.targets:
+                return False
+            target = self.targets[link]
+        return True
+
+    def _real_dir(self, path):
+        """Return the stable directory path resolves to, or None."""
+        try:
+            return self._real_dirs[path]
+        except KeyError:
+            pass
+        # A cycle back to path while it is being resolved ends as None.
+        self._real_dirs[path] = None
+        if path == self.root:
+            real = path
+        else:
+            parent, name = os.path.split(path)
+            real = self._real_dir(parent)
+            if real is not None:
+                real = os.path.join(real, name)
+                target = self.targets.get(real)
+                if target is not None:
+                    real = _follow(os.path.dirname(real), target, self.root)
+                    if real is not None:
+                        real = self._real_dir(real)
+                elif real in self.targets:
+                    real = None
+        if real is not None and real not in self._stable:
+            real = None
+        self._real_dirs[path] = real
+        return real
+
+
+def rescan_links(folder, snapshot_path, exclude=EXCLUDE, workers=1,
+                 resolver=None, stats=None):
+    """Like find_links(), but reusing the snapshot at snapshot_path.
+
+    Only directories whose mtime changed since the snapshot are listed
+    again, and a link in an unchanged directory is only checked again
+    when _TargetCheck says its target may have come or gone. The
+    result is the same as find_links(os.path.realpath(folder)) would
+    return. The snapshot is then rewritten for the next scan; pass a
+    RescanStats to see how much was reused.
+    """
+    root = os.path.realpath(folder)
+    exclude = tuple(exclude)
+    taken = time.time_ns()
+    snapshot = load_snapshot(snapshot_path, root, exclude)
+    old_dirs = snapshot['dirs'] if snapshot is not None else {}
+    trusted_before = (snapshot['taken'] - MTIME_SLACK_NS
+                      if snapshot is not None else 0)
+
+    list_dir = functools.partial(_rescan_dir, old_dirs=old_dirs,
+                                 trusted_before=trusted_before,
+                                 exclude=exclude, resolver=resolver)
+    scanned = [(path, record, listed)
+               for path, record, listed in walk_dirs([root], list_dir, workers)
+               if record is not None]
+    dirs = {path for path, _, _ in scanned}
+    changed = {path for path, _, listed in scanned if listed}
+    targets = {link: target for _, record, _ in scanned
+               for link, target, _ in record['links']}
+    target_changed = _TargetCheck(root, exclude, dirs, changed, targets)
+
+    links = []
+    broken = []
+    loops = []
+    new_dirs = {}
+    for path, record, listed in scanned:
+        if stats is not None:
+            if listed:
+                stats.dirs_listed += 1
+                stats.links_checked += len(record['links'])
             else:
-                # If it's not a symlink we're not interested.
-                continue
-    return links, broken
+                stats.dirs_reused += 1
+        if not listed:
+            entries = []
+            for link, target, status in record['links']:
+                if target_changed(link):
+                    status = link_status(link, resolver)
+                    if stats is not None:
+                        stats.links_checked += 1
+                elif stats is not None:
+                    stats.links_reused += 1
+                entries.append([link, target, status])
+            record = dict(record, links=entries)
+        new_dirs[path] = record
+        for link, _, status in record['links']:
+            links.append(link)
+            if status == BROKEN:
+                broken.append(link)
+            elif status == LOOP:
+                loops.append(link)
+
+    save_snapshot(snapshot_path, {'version': SNAPSHOT_VERSION, 'root': root,
+                                  'exclude': list(exclude), 'taken': taken,
+                                  'dirs': new_dirs})
+    return links, broken, loops
 
 
 def remove_links(link_list):
@@ -40,30 +355,67 @@ def remove_links(link_list):
         print(e)
 
 
-def print_links(links, broken):
-    if not broken:
+def print_links(links, broken, loops=()):
+    if not broken and not loops:
         print("\nSymlinks found... {}".format(len(links)))
         print("OK... No broken links")
         # print(*links, sep='\n')
-    else:
+    if broken:
         print("broken symlink(s) found:")
         for link in broken:
             print("Broke: {}".format(link))
+    if loops:
+        print("looping symlink(s) found:")
+        for link in loops:
+            print("Loop: {}".format(link))
 
 
 def main():
+    parser = argparse.ArgumentParser(
+        description='Look for broken and looping symlinks under a folder.')
+    parser.add_argument('folder', nargs='?',
+                        help='folder to check (asked for when left out)')
+    parser.add_argument('--snapshot', metavar='FILE',
+                        help='keep directory mtimes and links in FILE and '
+                             'only look again at what changed since')
+    parser.add_argument('--exclude', action='append', metavar='GLOB',
+                        help='skip entries matching GLOB (default: {})'.format(
+                            ', '.join(EXCLUDE)))
+    parser.add_argument('-j', '--workers', type=int, default=DEFAULT_WORKERS,
+                        help='directories listed at once (default: %(default)s)')
+    parser.add_argument('--resolve', action='store_true',
+                        help='follow links with a shared cache, which saves '
+                             'lookups on network filesystems')
+    args = parser.parse_args()
+    exclude = args.exclude if args.exclude is not None else EXCLUDE
+    resolver = LinkResolver() if args.resolve else None
+
+    # Relative to where we were started, not to the folder checked.
+    snapshot = (os.path.abspath(args.snapshot) if args.snapshot is not None
+                else None)
 
-    folder = input("\nFolder to check: ")
+    folder = args.folder or input("\nFolder to check: ")
     os.chdir(folder)
     cwd = os.getcwd()
 
     print("Checking for broken symlinks... {}".format(cwd))
 
-    ok_links, broken_links = find_links(cwd)
-    print_links(ok_links, broken_links)
+    if snapshot is not None:
+        stats = RescanStats()
+        ok_links, broken_links, loop_links = rescan_links(
+            cwd, snapshot, exclude, args.workers, resolver, stats)
+        print(stats)
+    else:
+        ok_links, broken_links, loop_links = find_links(
+            cwd, exclude, args.workers, resolver)
+    print_links(ok_links, broken_links, loop_links)
+    broken_links += loop_links
 
     if broken_links:
-        remove = input("\nRemove broken links? [default=N]: ") or "N"
+        try:
+            remove = input("\nRemove broken links? [default=N]: ") or "N"
+        except EOFError:
+            remove = "N"
         if remove[0] in 'Yy':
             remove_links(broken_links)
         else:
@@ -5,21 +5,62 @@ Original Author: Andres Torres
 
 Adapted to compute the md5sum of same size files.
 """
+import argparse
 import os
+import stat
 import sys
 import hashlib
+import time
 
+import fast_hash
+from parallel_hash import DEFAULT_WORKERS, hash_paths
+from scan_tree import ScanStats, scan_files
 
-def find_dups(parent_folder):
+
+def find_dups(parent_folder, metrics=None):
     # Dups in format {hash:[names]}
+    # Walks like os.walk(), so symlinks to files are hashed as the file
+    # they point to. A scan_metrics.ScanMetrics passed as metrics replaces
+    # the per-directory 'Scanning' lines with a rate-limited progress line.
     dups = {}
+    # Hash of every inode with several links, so that its other links join
+    # the group without being read again.
+    linked = {}
     for dirName, subdirs, fileList in os.walk(parent_folder):
-        print('Scanning %s...' % dirName)
+        if metrics is None:
+            print('Scanning %s...' % dirName)
+        else:
+            metrics.dirs += 1
+            metrics.files += len(fileList)
+            metrics.tick()
         for filename in fileList:
             # Get the path to the file
             path = os.path.join(dirName, filename)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                # Reading a FIFO or device could block or never end.
+                continue
+            if st.st_nlink > 1:
+                file_hash = linked.get((st.st_dev, st.st_ino))
+                if file_hash is not None:
+                    dups[file_hash].append(path)
+                    continue
             # Calculate hash
-            file_hash = hashfile(path)
+            if metrics is not None:
+                start = time.perf_counter()
+            try:
+                file_hash = hashfile(path)
+            except OSError:
+                continue
+            if metrics is not None:
+                metrics.add('hash', candidates=1, files=1,
+                            nbytes=st.st_size,
+                            seconds=time.perf_counter() - start)
+            if st.st_nlink > 1:
+                linked[(st.st_dev, st.st_ino)] = file_hash
             # Add or append the file path
             if file_hash in dups:
                 dups[file_hash].append(path)
@@ -28,31 +69,40 @@ def find_dups(parent_folder):
     return dups
 
 
-def find_dup_size(parent_folder):
-    # Dups in format {hash:[names]}
+def find_dup_size(parent_folder, workers=1, links=None):
+    # Dups in format {size:[names]}
+    # With a links dict, which maps (st_dev, st_ino) to the paths of each
+    # inode with several links and can be shared across folders, only
+    # the first path of such an inode is added.
     dups = {}
-    for dirName, subdirs, fileList in os.walk(parent_folder):
-        print('Scanning %s...' % dirName)
-        for filename in fileList:
-            # Get the path to the file
-            path = os.path.join(dirName, filename)
-            # Calculate hash
-            file_size = os.path.getsize(path)
-            # Add or append the file path
-            if file_size in dups:
-                dups[file_size].append(path)
-            else:
-                dups[file_size] = [path]
+    print('Scanning %s...' % parent_folder)
+    stats = ScanStats()
+    for path, st in scan_files([parent_folder], workers=workers, stats=stats):
+        if links is not None and st.st_nlink > 1:
+            paths = links.setdefault((st.st_dev, st.st_ino), [])
+            paths.append(path)
+            if len(paths) > 1:
+                continue
+        # Add or append the file path
+        if st.st_size in dups:
+            dups[st.st_size].append(path)
+        else:
+            dups[st.st_size] = [path]
+    if stats.errors:
+        print('%d entries in %s could not be read' % (stats.errors, parent_folder))
     return dups
 
 
-def find_dup_hash(file_list):
+def find_dup_hash(file_list, workers=1):
     print('Comparing: ')
     for filename in file_list:
         print('    {}'.format(filename))
     dups = {}
+    hashes = hash_paths(file_list, hashfile, workers=workers)
     for path in file_list:
-        file_hash = hashfile(path)
+        if path not in hashes:
+            continue
+        file_hash = hashes[path]
         if file_hash in dups:
             dups[file_hash].append(path)
         else:
@@ -69,53 +119,81 @@ def join_dicts(dict1, dict2):
             dict1[key] = dict2[key]
 
 
-def hashfile(path, blocksize=65536):
-    afile = open(path, 'rb')
-    hasher = hashlib.sha1()
-    buf = afile.read(blocksize)
-    while len(buf) > 0:
-        hasher.update(buf)
-        buf = afile.read(blocksize)
-    afile.close()
-    return hasher.hexdigest()
+def hashfile(path, blocksize=None):
+    # blocksize None uses the block size configured for the file's device
+    return fast_hash.hash_file(path, hashlib.sha1, blocksize)
+
+
+def print_header():
+    print('Duplicates Found:')
+    print('The following files are identical. The name could differ, but the content is identical')
+    print('___________________')
+
+
+def print_group(result):
+    for subresult in result:
+        print('\t\t%s' % subresult)
+    print('___________________', flush=True)
 
 
 def print_results(dict1):
     results = list(filter(lambda x: len(x) > 1, dict1.values()))
     if len(results) > 0:
-        print('Duplicates Found:')
-        print('The following files are identical. The name could differ, but the content is identical')
-        print('___________________')
+        print_header()
         for result in results:
-            for subresult in result:
-                print('\t\t%s' % subresult)
-            print('___________________')
+            print_group(result)
 
     else:
         print('No duplicate files found.')
 
 
-def main(folders):
+def main(folders, workers=1):
     dup_size = {}
+    links = {}
     for i in folders:
         # Iterate the folders given
         if os.path.exists(i):
             # Find the duplicated files and append them to dup_size
-            join_dicts(dup_size, find_dup_size(i))
+            join_dicts(dup_size, find_dup_size(i, workers=workers,
+                                               links=links))
         else:
             print('%s is not a valid path, please verify' % i)
             sys.exit()
 
     print('Comparing files with the same size...')
-    dups = {}
+    # Hard links are hashed once, through the first path of their inode,
+    # and reported in its group; an inode with several links is a group
+    # of its own even when nothing else matches it.
+    others = {paths[0]: paths[1:] for paths in links.values()
+              if len(paths) > 1}
+    # Print each group as soon as its size class is hashed rather than
+    # collecting every group first.
+    found = 0
     for dup_list in dup_size.values():
-        if len(dup_list) > 1:
-            join_dicts(dups, find_dup_hash(dup_list))
-        print_results(dups)
+        if len(dup_list) < 2:
+            continue
+        for result in find_dup_hash(dup_list, workers=workers).values():
+            result = [linked for path in result
+                      for linked in [path] + others.pop(path, [])]
+            if len(result) > 1:
+                if not found:
+                    print_header()
+                print_group(result)
+                found += 1
+    for first, paths in others.items():
+        if not found:
+            print_header()
+        print_group([first] + paths)
+        found += 1
+    if not found:
+        print('No duplicate files found.')
 
 
 if __name__ == '__main__':
-    if len(sys.argv) > 1:
-        main(sys.argv[1:])
-    else:
-        print('Usage: python dupFinder.py folder or python dupFinder.py folder1 folder2 folder3')
+    parser = argparse.ArgumentParser(
+        description='Find duplicate files in one or more folders.')
+    parser.add_argument('folders', nargs='+')
+    parser.add_argument('-j', '--workers', type=int, default=DEFAULT_WORKERS,
+                        help='concurrent hashing workers (default: %(default)s)')
+    args = parser.parse_args()
+    main(args.folders, workers=args.workers)
@@ -0,0 +1,85 @@
+"""Zero-copy file hashing backend for the duplicate finders.
+
+Files are read with readinto() into a per-thread bytearray that is
+reused across files, so no bytes objects are allocated. The kernel is
+told to expect sequential reads with posix_fadvise where the platform
+has it.
+
+Large files can be mmap'd instead by passing mmap_threshold. That is
+off by default: a file that shrinks while it is mapped (a log rotated
+with copytruncate) kills the process with SIGBUS, and reading into the
+reused buffer is as fast.
+"""
+
+import hashlib
+import mmap
+import os
+import threading
+
+DEFAULT_BLOCK_SIZE = 1 << 20
+
+# Files at least this big are hashed through mmap; None never maps.
+MMAP_THRESHOLD = None
+
+# Block size per st_dev, set with set_block_size().
+BLOCK_SIZES = {}
+
+_local = threading.local()
+
+
+def set_block_size(path, block_size):
+    """Use block_size for every file on the device holding path."""
+    BLOCK_SIZES[os.stat(path).st_dev] = block_size
+
+
+def _buffer(block_size):
+    """Return this thread's reusable read buffer of block_size bytes."""
+    buf = getattr(_local, 'buffer', None)
+    if buf is None or len(buf) != block_size:
+        buf = _local.buffer = bytearray(block_size)
+    return buf
+
+
+def update_from_file(hashobj, path, block_size=None, mmap_threshold=MMAP_THRESHOLD):
+    """Feed the whole content of path to hashobj and return it.
+
+    block_size defaults to the size registered for the file's device, or
+    DEFAULT_BLOCK_SIZE. Only use mmap_threshold for files nothing else
+    writes to while they are hashed.
+    """
+    with open(path, 'rb', buffering=0) as f:
+        st = os.fstat(f.fileno())
+        if block_size is None:
+            block_size = BLOCK_SIZES.get(st.st_dev, DEFAULT_BLOCK_SIZE)
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        if mmap_threshold is not None and st.st_size >= mmap_threshold:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mm, 'madvise'):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                view = memoryview(mm)
+                try:
+                    for start in range(0, len(view), block_size):
+                        hashobj.update(view[start:start + block_size])
+                finally:
+                    view.release()
+            return hashobj
+
+        buf = _buffer(block_size)
+        view = memoryview(buf)
+        readinto = f.readinto
+        while True:
+            n = readinto(buf)
+            if not n:
+                break
+            hashobj.update(view[:n])
+        view.release()
+    return hashobj
+
+
+def hash_file(path, hash_factory=hashlib.sha1, block_size=None,
+              mmap_threshold=MMAP_THRESHOLD):
+    """Return the hex digest of path using a fresh hash_factory() object."""
+    return update_from_file(hash_factory(), path, block_size,
+                            mmap_threshold).hexdigest()
@@ -4,102 +4,453 @@
 """
 
 
-import xxhash
-import sys
+import argparse
+import contextlib
+import functools
+import json
 import os
 import pprint
+import struct
+import sys
+import time
+from array import array
+from collections import namedtuple
+
+import xxhash
 
+import fast_hash
+from hash_cache import DEFAULT_PATH, HashCache
+from parallel_hash import DEFAULT_WORKERS, hash_paths
+from reclaim import LINKERS, reclaim_groups
+from scan_metrics import ScanMetrics
+from scan_tree import ScanStats, scan_files
 
-def chunk_reader(fobj, chunk_size=1024):
-    """Generator that reads a file in chunks of bytes."""
-    while True:
-        chunk = fobj.read(chunk_size)
-        if not chunk:
-            return
-        yield chunk
+# Candidate files hashed per batch by iter_duplicate_groups().
+BATCH_SIZE = 4096
 
 
 def get_hash(filename, first_chunk=False, myhash=xxhash.xxh64):
     """Hash files to verify if they're different."""
-    hashobj = myhash()
-    file_object = open(filename, 'rb')
+    if not first_chunk:
+        return fast_hash.hash_file(filename, myhash)
 
-    if first_chunk:
+    hashobj = myhash()
+    with open(filename, 'rb') as file_object:
         hashobj.update(file_object.read(1024))
-    else:
-        for chunk in chunk_reader(file_object):
-            hashobj.update(chunk)
-    hashed = hashobj.hexdigest()
-
-    file_object.close()
-    return hashed
-
-
-def sort_by_size(paths):
-    hashes_by_size = {}
-    for path in paths:
-        for dirpath, dirnames, filenames in os.walk(path):
-            for filename in filenames:
-                full_path = os.path.join(dirpath, filename)
-                try:
-                    file_size = str(os.path.getsize(full_path))
-                except OSError:
-                    # Not accessible (permissions, etc)
-                    pass
-
-                duplicate = hashes_by_size.get(file_size)
-                if duplicate:
-                    hashes_by_size[file_size].append(full_path)
-                else:
-                    hashes_by_size[file_size] = []  # create list for this file size
-                    hashes_by_size[file_size].append(full_path)
-    return hashes_by_size
-
-
-def hash_files(sorted_files, first_chunk=False):
-    hashes_full = {}
-    for _, files in sorted_files.items():
-        if len(files) < 2:
-            continue
+    return hashobj.hexdigest()
 
-        for filename in files:
-            small_hash = get_hash(filename, first_chunk=False)
 
-            duplicate = hashes_full.get(small_hash)
-            if duplicate:
-                hashes_full[small_hash].append(filename)
+def get_sample_hash(filename, sample_size=1024, tail=False, myhash=xxhash.xxh64):
+    """Hash the first (and optionally last) sample_size bytes of a file."""
+    hashobj = myhash()
+    with open(filename, 'rb') as file_object:
+        hashobj.update(file_object.read(sample_size))
+        if tail:
+            file_object.seek(0, os.SEEK_END)
+            end = file_object.tell()
+            if end > sample_size:
+                file_object.seek(max(sample_size, end - sample_size))
+                hashobj.update(file_object.read(sample_size))
+    return hashobj.hexdigest()
+
+
+# The parts of a file's stat result that a HashCache looks at.
+FileStat = namedtuple('FileStat', 'st_dev st_ino st_size st_mtime_ns')
+
+# st_dev, st_ino and st_mtime_ns as PathIndex keeps them.
+_STAT = struct.Struct('QQq')
+
+
+class PathIndex:
+    """Paths grouped by file size, stored compactly.
+
+    Each directory string is kept once and files refer to it by index,
+    and a size seen only once holds a bare (dir_index, name, stat) tuple
+    rather than lists, since most sizes in a large tree are unique. The
+    device, inode and mtime from the scan are packed alongside, so the
+    hash stages can check a HashCache without stat'ing files again.
+    """
+
+    def __init__(self):
+        self.dirs = []
+        self._dir_ids = {}
+        self._by_size = {}
+        self.files = 0
+
+    def __len__(self):
+        return len(self._by_size)
+
+    def add(self, path, st):
+        """Add a file given its stat result."""
+        size = st.st_size
+        packed = _STAT.pack(st.st_dev, st.st_ino, st.st_mtime_ns)
+        dirname, name = os.path.split(path)
+        dir_id = self._dir_ids.get(dirname)
+        if dir_id is None:
+            dir_id = self._dir_ids[dirname] = len(self.dirs)
+            self.dirs.append(dirname)
+        self.files += 1
+
+        entry = self._by_size.get(size)
+        if entry is None:
+            self._by_size[size] = (dir_id, name, packed)
+        elif isinstance(entry, tuple):
+            self._by_size[size] = [array('I', [entry[0], dir_id]),
+                                   [entry[1], name],
+                                   bytearray(entry[2] + packed)]
+        else:
+            entry[0].append(dir_id)
+            entry[1].append(name)
+            entry[2] += packed
+
+    def _paths(self, entry):
+        dirs = self.dirs
+        if isinstance(entry, tuple):
+            return [os.path.join(dirs[entry[0]], entry[1])]
+        return [os.path.join(dirs[dir_id], name)
+                for dir_id, name in zip(entry[0], entry[1])]
+
+    def items(self):
+        """Yield (size, paths) for every size, singletons included."""
+        for size, entry in self._by_size.items():
+            yield size, self._paths(entry)
+
+    def pop_groups(self):
+        """Yield and forget (size, paths, stats) for sizes shared by 2+ files.
+
+        stats holds a FileStat for each of paths, taken during the scan.
+        """
+        sizes = [size for size, entry in self._by_size.items()
+                 if isinstance(entry, list)]
+        for size in sizes:
+            entry = self._by_size.pop(size)
+            stats = [FileStat(dev, ino, size, mtime_ns)
+                     for dev, ino, mtime_ns in _STAT.iter_unpack(entry[2])]
+            yield size, self._paths(entry), stats
+
+
+def index_by_size(paths, workers=1, stats=None, links=None):
+    """Return a PathIndex of the regular files under paths.
+
+    Symlinks and special files are skipped and every file is stat'ed
+    once; pass a scan_tree.ScanStats to see how many entries were skipped
+    or could not be read.
+
+    When a links dictionary is given, hard links are collapsed: only the
+    first path seen for each inode is indexed, and links maps that path
+    to the inode's other paths.
+    """
+    index = PathIndex()
+    inodes = {}
+    for full_path, st in scan_files(paths, workers=workers, stats=stats):
+        if links is not None and st.st_nlink > 1:
+            first = inodes.setdefault((st.st_dev, st.st_ino), full_path)
+            if first != full_path:
+                links.setdefault(first, []).append(full_path)
+                continue
+        index.add(full_path, st)
+    return index
+
+
+def sort_by_size(paths, workers=1, stats=None, links=None):
+    """Return {size: [paths]} for the regular files under paths.
+
+    Takes the same arguments as index_by_size().
+    """
+    return dict(index_by_size(paths, workers, stats, links).items())
+
+
+def refine_groups(groups, key, workers=1, processes=False, sizes=None,
+                  cache=None, kind=None, stats=None):
+    """Split every candidate group by key(path).
+
+    Returns the subgroups that still hold two or more files, and the
+    number of candidates that dropped out because their key was unique.
+    Files that can no longer be read also drop out. The keys are computed
+    by hash_paths(), so workers > 1 hashes concurrently while producing
+    the same groups as the serial path. With a HashCache, keys for
+    unchanged files are read from the cache under the given kind; stats
+    can map paths to stat results the caller already has for it.
+    """
+    filenames = [filename for files in groups for filename in files]
+    if cache is None:
+        keys = hash_paths(filenames, key, workers=workers,
+                          processes=processes, sizes=sizes)
+    else:
+        keys = cache.hash_paths(filenames, key, kind, stats=stats,
+                                workers=workers, processes=processes,
+                                sizes=sizes)
+    refined = []
+    eliminated = 0
+    for files in groups:
+        by_key = {}
+        for filename in files:
+            if filename in keys:
+                by_key.setdefault(keys[filename], []).append(filename)
+            else:
+                eliminated += 1
+        for subgroup in by_key.values():
+            if len(subgroup) > 1:
+                refined.append(subgroup)
             else:
-                hashes_full[small_hash] = []
-                hashes_full[small_hash].append(filename)
-    return hashes_full
+                eliminated += 1
+    return refined, eliminated
 
 
-def check_for_duplicates(paths, myhash=xxhash.xxh64):
-    """Return a dictionary of duplicate files
+def iter_duplicate_groups(paths, myhash=xxhash.xxh64, tail=False,
+                          sample_size=1024, workers=1, processes=False,
+                          cache=None, report=None, batch_size=BATCH_SIZE,
+                          metrics=None):
+    """Yield each group of duplicate files under paths as soon as it is final.
+
+    Candidates pass through three stages, and each stage only sees the
+    files the previous one could not tell apart:
+
+    1. size: files with a unique size are dropped without being read.
+    2. head: a hash of the first sample_size bytes (plus the last
+       sample_size bytes when tail is true).
+    3. full: a hash of the whole content.
+
+    After the size stage, same-size classes are taken batch_size files
+    at a time through the hash stages, and their groups are yielded and
+    dropped before the next batch starts.
+
+    Hard links to one inode are hashed once and always end up together
+    in a single group; an inode with several links is reported as a group
+    even when no other file matches it.
+
+    Directory listing and the hash stages run on workers concurrent
+    threads (hashing can use processes instead). Digests of unchanged
+    files are reused from cache, a HashCache, when one is given.
+
+    When report is a list, it is filled with one [stage, candidates,
+    eliminated] entry per stage, updated as batches complete. A
+    scan_metrics.ScanMetrics passed as metrics receives walk counters and
+    per-stage candidates, files read, bytes read and time spent.
+    """
+    if report is None:
+        report = []
+    scan_stats = ScanStats() if metrics is None else metrics
+    links = {}
+    start = time.perf_counter()
+    index = index_by_size(paths, workers=workers, stats=scan_stats,
+                          links=links)
+    if metrics is not None:
+        metrics.add('walk', candidates=scan_stats.files,
+                    seconds=time.perf_counter() - start)
+    if scan_stats.errors:
+        if metrics is not None:
+            metrics.clear()
+        print(f'{scan_stats.errors} entries could not be read')
+
+    head_key = functools.partial(get_sample_hash, sample_size=sample_size,
+                                 tail=tail, myhash=myhash)
+    full_key = functools.partial(get_hash, myhash=myhash)
+    name = getattr(myhash, '__name__', repr(myhash))
+    head_bytes = sample_size * (2 if tail else 1)
+    stages = (('head', head_key, f'head:{name}:{sample_size}:{int(tail)}',
+               lambda size: min(size, head_bytes)),
+              ('full', full_key, f'full:{name}', lambda size: size))
+    size_stage = ['size', index.files, index.files]
+    report[:] = [size_stage] + [[stage[0], 0, 0] for stage in stages]
+
+    def confirm(batch, sizes, file_stats):
+        groups = batch
+        for counts, (stage, key, kind, read_size) in zip(report[1:], stages):
+            candidates = [filename for files in groups for filename in files]
+            counts[1] += len(candidates)
+            start = time.perf_counter()
+            groups, eliminated = refine_groups(groups, key, workers=workers,
+                                               processes=processes,
+                                               sizes=sizes, cache=cache,
+                                               kind=kind, stats=file_stats)
+            counts[2] += eliminated
+            if metrics is not None:
+                hashed = candidates if cache is None else cache.last_hashed
+                metrics.add(stage, candidates=len(candidates),
+                            files=len(hashed),
+                            nbytes=sum(read_size(sizes[f]) for f in hashed),
+                            seconds=time.perf_counter() - start)
+        for files in groups:
+            yield [linked for filename in files
+                   for linked in [filename] + links.pop(filename, [])]
+
+    # The cache is checked against the scan's stat results, which saves
+    # an os.stat() per candidate at every stage.
+    batch, sizes, file_stats = [], {}, {}
+    for size, files, stats in index.pop_groups():
+        size_stage[2] -= len(files)
+        batch.append(files)
+        sizes.update(dict.fromkeys(files, size))
+        if cache is not None:
+            file_stats.update(zip(files, stats))
+        if len(sizes) >= batch_size:
+            yield from confirm(batch, sizes, file_stats)
+            batch, sizes, file_stats = [], {}, {}
+    yield from confirm(batch, sizes, file_stats)
+
+    for first, others in links.items():
+        yield [first] + others
+
+
+def find_duplicate_groups(paths, myhash=xxhash.xxh64, tail=False, sample_size=1024,
+                          workers=1, processes=False, cache=None, metrics=None):
+    """Return (groups, report) for the files under paths.
+
+    See iter_duplicate_groups() for the stages. report is a list of
+    (stage, candidates, eliminated) tuples.
+    """
+    report = []
+    groups = list(iter_duplicate_groups(paths, myhash=myhash, tail=tail,
+                                        sample_size=sample_size,
+                                        workers=workers, processes=processes,
+                                        cache=cache, report=report,
+                                        metrics=metrics))
+    return groups, [tuple(counts) for counts in report]
 
 
+def write_group(files, out, fmt='jsonl'):
+    """Write one duplicate group to out and flush it.
+
+    'jsonl' writes a JSON array of paths per line. 'nul' writes every
+    path followed by a NUL byte and ends the group with an extra NUL,
+    which is safe for any file name.
+    """
+    if fmt == 'jsonl':
+        out.write(json.dumps(files) + '\n')
+    else:
+        out.write(''.join(path + '\0' for path in files) + '\0')
+    out.flush()
+
+
+def stream_duplicates(paths, out=None, fmt='jsonl', reclaim=None,
+                      dry_run=False, **options):
+    """Write each duplicate group to out (stdout) as soon as it is confirmed.
+
+    Memory holds the size index and one batch of candidates, never the
+    full result. Messages and the stage report go to stderr so they
+    can't mix with the groups. Other keyword arguments are passed to
+    iter_duplicate_groups(); a progress line from its metrics is cleared
+    before each group and ended before the report.
     """
-    hashes_by_size = sort_by_size(paths)
-    hashes_full = hash_files(hashes_by_size)
+    if out is None:
+        out = sys.stdout
+    metrics = options.get('metrics')
+    report = []
+    replaced = freed = 0
+    with contextlib.redirect_stdout(sys.stderr):
+        for files in iter_duplicate_groups(paths, report=report, **options):
+            if metrics is not None:
+                metrics.clear()
+            if reclaim:
+                done, saved = reclaim_groups([files], mode=reclaim,
+                                             dry_run=dry_run)
+                replaced += done
+                freed += saved
+            write_group(files, out, fmt)
+        if metrics is not None:
+            metrics.close()
+        print_report(report)
+        if reclaim:
+            print_reclaimed(reclaim, replaced, freed, dry_run)
+
+
+def print_report(report):
+    for stage, candidates, eliminated in report:
+        print(f'{stage} stage: {candidates} candidates, {eliminated} eliminated')
+
+
+def print_reclaimed(mode, replaced, freed, dry_run=False):
+    action = 'Would replace' if dry_run else 'Replaced'
+    print(f'{action} {replaced} files with {mode}s, freeing {freed} bytes')
+
+
+def check_for_duplicates(paths, myhash=xxhash.xxh64, tail=False, workers=1,
+                         processes=False, cache=None, reclaim=None,
+                         dry_run=False, metrics=None):
+    """Return a dictionary of duplicate files
+
+    The key is the base name of the first file in each group and the
+    value lists the paths of its duplicates. With reclaim set to
+    'hardlink' or 'reflink', the duplicates are then replaced by links to
+    the first file of their group (see reclaim.reclaim_groups()).
+    """
+    groups, report = find_duplicate_groups(paths, myhash=myhash, tail=tail,
+                                           workers=workers, processes=processes,
+                                           cache=cache, metrics=metrics)
+    if metrics is not None:
+        metrics.close()
+    print_report(report)
+    if reclaim:
+        replaced, freed = reclaim_groups(groups, mode=reclaim, dry_run=dry_run)
+        print_reclaimed(reclaim, replaced, freed, dry_run)
     duplicates = {}
 
-    for _, files in hashes_full.items():
-        if len(files) > 1:
-            first_file = files.pop(0)
-            first_file = os.path.basename(first_file)
-            duplicates[first_file] = []
-            for file in files:
-                print(f'{file} is a duplicate of {first_file}')
-                duplicates[first_file].append(file)
+    for files in groups:
+        first_file = files.pop(0)
+        first_file = os.path.basename(first_file)
+        duplicates[first_file] = []
+        for file in files:
+            print(f'{file} is a duplicate of {first_file}')
+            duplicates[first_file].append(file)
 
     return duplicates
 
 
 def main():
-    if sys.argv[1:]:
-        pprint.pprint(check_for_duplicates(sys.argv[1:]))
-    else:
-        print('Pass the paths to check as parameters to the script.')
+    parser = argparse.ArgumentParser(description='Find duplicate files.')
+    parser.add_argument('paths', nargs='+', help='directories to scan')
+    parser.add_argument('--tail', action='store_true',
+                        help='also sample the last 1 KiB before full hashing')
+    parser.add_argument('-j', '--workers', type=int, default=DEFAULT_WORKERS,
+                        help='concurrent hashing workers (default: %(default)s)')
+    parser.add_argument('--processes', action='store_true',
+                        help='hash in a process pool instead of threads')
+    parser.add_argument('--cache', nargs='?', const=DEFAULT_PATH,
+                        metavar='PATH',
+                        help='reuse digests from a persistent hash cache '
+                             '(default path: %(const)s)')
+    parser.add_argument('--prune', action='store_true',
+                        help='evict deleted and stale entries from the cache')
+    parser.add_argument('--reclaim', choices=sorted(LINKERS),
+                        help='replace verified duplicates with links')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='with --reclaim, only report what would change')
+    parser.add_argument('--format', choices=('pprint', 'jsonl', 'nul'),
+                        default='pprint',
+                        help='jsonl and nul stream each group to stdout as '
+                             'soon as it is confirmed (default: %(default)s)')
+    parser.add_argument('--progress', nargs='?', type=float, const=1.0,
+                        metavar='SECONDS',
+                        help='show a progress line on stderr, refreshed at '
+                             'most every SECONDS (default: %(const)s)')
+    args = parser.parse_args()
+    metrics = None
+    if args.progress is not None:
+        metrics = ScanMetrics(interval=args.progress)
+    options = dict(tail=args.tail, workers=args.workers,
+                   processes=args.processes, reclaim=args.reclaim,
+                   dry_run=args.dry_run, metrics=metrics)
+
+    def run(cache=None):
+        if args.format == 'pprint':
+            duplicates = check_for_duplicates(args.paths, cache=cache,
+                                              **options)
+            pprint.pprint(duplicates)
+        else:
+            stream_duplicates(args.paths, fmt=args.format, cache=cache,
+                              **options)
+
+    if args.cache is None:
+        run()
+        return
+
+    with HashCache(args.cache) as cache:
+        if args.prune:
+            print(f'Pruned {cache.prune()} cache entries', file=sys.stderr)
+        run(cache)
+        print(f'Cache: {cache.hits} hits, {cache.misses} misses',
+              file=sys.stderr)
 
 
 if __name__ == '__main__':
@@ -1,47 +1,524 @@
 #! /usr/bin/env python3
 """Python style grep"""
 
-import sys
+import argparse
+import bz2
+import errno
+import gzip
+import lzma
+import mmap
+import os
 import re
-import fileinput
+import sys
+import zlib
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Bytes read per block. Files are read rather than mmap'd: a mapped file
+# that shrinks while it is searched (a log rotated with copytruncate)
+# kills the process with SIGBUS.
+BLOCK_SIZE = 1 << 20
+
+# A NUL byte in this many leading bytes marks a file as binary for -r.
+BINARY_SAMPLE = 8192
+
+# Leading bytes of the compressed formats searched transparently.
+MAGIC = ((b'\x1f\x8b', 'gzip'), (b'BZh', 'bzip2'), (b'\xfd7zXZ\x00', 'xz'),
+         (b'\x28\xb5\x2f\xfd', 'zstd'))
+
+# Errors the decompressors raise for corrupt or truncated input.
+DECOMPRESS_ERRORS = (EOFError, lzma.LZMAError, zlib.error) + (
+    (zstandard.ZstdError,) if zstandard is not None else ())
+
+# Directory names -r never descends into.
+EXCLUDE_DIRS = frozenset(('.git', '.hg', '.svn', '__pycache__', '.tox',
+                          '.venv', 'node_modules'))
+
+
+def compile_pattern(search_string, ignore_case=True):
+    """Compile search_string once as a bytes regex.
+
+    Matching runs on raw bytes, so nothing is decoded; IGNORECASE then
+    folds ASCII letters only.
+    """
+    flags = re.MULTILINE | (re.IGNORECASE if ignore_case else 0)
+    return re.compile(os.fsencode(search_string), flags)
+
+
+def literal_source(literals):
+    """Return regex source (bytes) matching any of the byte strings literals.
+
+    The literals are merged into a trie, so the regex engine walks shared
+    prefixes once and rejects most start positions on their first byte,
+    instead of trying every alternative in turn. At a given position the
+    longest literal wins.
+    """
+    trie = {}
+    for literal in literals:
+        node = trie
+        for byte in literal:
+            node = node.setdefault(byte, {})
+        node[None] = True
+    return _trie_source(trie)
+
+
+def _trie_source(node):
+    alternatives = []
+    for byte in sorted(key for key in node if key is not None):
+        child = node[byte]
+        chain = bytes((byte,))
+        # Emit runs without branches as one literal.
+        while len(child) == 1 and None not in child:
+            (byte, child), = child.items()
+            chain += bytes((byte,))
+        alternatives.append(re.escape(chain) + _trie_source(child))
+    if not alternatives:
+        return b''
+    if len(alternatives) == 1:
+        source = alternatives[0]
+    else:
+        source = b'(?:' + b'|'.join(alternatives) + b')'
+    if None in node:
+        # A literal ends here; the greedy ? still prefers a longer one.
+        source = b'(?:' + source + b')?'
+    return source
+
+
+class PatternSet:
+    """Several patterns searched for in a single pass.
+
+    regex matches wherever any of the patterns does and is what gets
+    handed to the search functions; which() then tells the patterns of a
+    matching line apart. With fixed the patterns are literal strings,
+    otherwise they are regexes joined as named alternatives, so the first
+    pattern matching at the leftmost position is the one reported.
+    """
+
+    def __init__(self, patterns, fixed=False, ignore_case=True):
+        self.patterns = [os.fsencode(pattern) for pattern in patterns]
+        self.fixed = fixed
+        self.ignore_case = ignore_case
+        if not self.patterns:
+            # Like grep -f with an empty file: an empty alternation would
+            # match every line, this matches none.
+            source = b'(?!)'
+        elif fixed:
+            source = literal_source(self._key(pattern)
+                                    for pattern in self.patterns)
+            self._index = {}
+            for i, pattern in enumerate(self.patterns):
+                self._index.setdefault(self._key(pattern), i)
+        elif len(self.patterns) == 1:
+            source = self.patterns[0]
+        else:
+            source = b'|'.join(b'(?P<p%d>%s)' % (i, pattern)
+                               for i, pattern in enumerate(self.patterns))
+        self.regex = compile_pattern(source, ignore_case)
+
+    def _key(self, literal):
+        return literal.lower() if self.ignore_case else literal
+
+    def which(self, line):
+        """Return the index of the pattern that matches line, or None."""
+        match = self.regex.search(line)
+        if match is None:
+            return None
+        if self.fixed:
+            return self._index[self._key(match.group())]
+        if match.lastgroup is None:
+            return 0
+        return int(match.lastgroup[1:])
+
+
+def read_patterns(file_name):
+    """Return the patterns in file_name, one per line ('-' for stdin)."""
+    if file_name == '-':
+        return sys.stdin.buffer.read().splitlines()
+    with open(file_name, 'rb') as f:
+        return f.read().splitlines()
+
+
+def search_buffer(regex, buf, start=0, end=None, line_number=1):
+    """Yield (line_number, line) for each line of buf[start:end] that matches.
+
+    The whole buffer is searched with one regex scan; line boundaries and
+    line numbers are only worked out around the matches. line_number is
+    the number of the line that begins at start. Lines keep their b'\\n'.
+    """
+    if end is None:
+        end = len(buf)
+    search = regex.search
+    counted = start
+    pos = start
+    while pos < end:
+        match = search(buf, pos, end)
+        if match is None:
+            return
+        if match.start() == end and (end == start or buf[end - 1] == 10):
+            # An empty match after the final newline belongs to the next
+            # line, which is not part of this buffer.
+            return
+        line_start = buf.rfind(b'\n', start, match.start()) + 1 or start
+        newline = buf.find(b'\n', match.start(), end)
+        content_end = end if newline == -1 else newline
+        # A match that runs past the end of its line (a pattern that can
+        # match b'\n') only counts if the line matches on its own.
+        if match.end() > content_end and search(buf, line_start, content_end) is None:
+            pos = content_end + 1
+            continue
+        line_end = end if newline == -1 else newline + 1
+        line_number += count_newlines(buf, counted, line_start)
+        counted = line_start
+        yield line_number, buf[line_start:line_end]
+        pos = line_end
+
+
+def count_newlines(buf, start, end, step=1 << 24):
+    """Return buf.count(b'\\n', start, end), also for mmap objects.
+
+    mmap has no count(), so it is counted through bounded slices.
+    """
+    if not isinstance(buf, mmap.mmap):
+        return buf.count(b'\n', start, end)
+    return sum(buf[i:min(i + step, end)].count(b'\n')
+               for i in range(start, end, step))
+
+
+def search_stream(regex, fobj, block_size=BLOCK_SIZE):
+    """Like search_buffer() over a binary stream read block by block.
+
+    Each block is cut at its last newline and the partial line is carried
+    over to the next one, so lines are never split. Blocks without a
+    newline are only collected, and joined once the line ends, so a very
+    long line is not copied again for every block.
+    """
+    line_number = 1
+    pending = []
+    while True:
+        block = fobj.read(block_size)
+        if not block:
+            break
+        cut = block.rfind(b'\n') + 1
+        if not cut:
+            pending.append(block)
+            continue
+        if pending:
+            pending.append(block)
+            buf = b''.join(pending)
+            cut += len(buf) - len(block)
+        else:
+            buf = block
+        yield from search_buffer(regex, buf, 0, cut, line_number)
+        line_number += count_newlines(buf, 0, cut)
+        pending = [buf[cut:]] if cut < len(buf) else []
+    if pending:
+        tail = b''.join(pending)
+        yield from search_buffer(regex, tail, 0, len(tail), line_number)
+
+
+def compression(fobj):
+    """Return the name of the format fobj is compressed with, or None.
+
+    Only peeks at the leading bytes, so fobj must be a buffered reader.
+    """
+    head = fobj.peek(max(len(magic) for magic, _ in MAGIC))
+    for magic, name in MAGIC:
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def decompressed(fobj, name):
+    """Wrap fobj in a reader that decompresses name format on the fly."""
+    if name == 'gzip':
+        return gzip.GzipFile(fileobj=fobj)
+    if name == 'bzip2':
+        return bz2.BZ2File(fobj)
+    if name == 'xz':
+        return lzma.LZMAFile(fobj)
+    if zstandard is None:
+        raise OSError(errno.ENOTSUP, 'zstd input needs the zstandard package')
+    return zstandard.ZstdDecompressor().stream_reader(fobj)
+
+
+def search_file(regex, file_name, decompress=True):
+    """Yield (line_number, line) for the matching lines of file_name.
+
+    Files are read in BLOCK_SIZE blocks; '-' reads stdin.
+    gzip, bzip2, xz and zstd input is recognised by its magic bytes and
+    searched as it is decompressed, unless decompress is False.
+    """
+    if file_name == '-':
+        yield from _search_input(regex, sys.stdin.buffer, file_name,
+                                 decompress)
+        return
+    with open(file_name, 'rb') as f:
+        yield from _search_input(regex, f, file_name, decompress)
+
+
+def _search_input(regex, f, file_name, decompress):
+    name = compression(f) if decompress else None
+    if name is not None:
+        try:
+            with decompressed(f, name) as stream:
+                yield from search_stream(regex, stream)
+        except DECOMPRESS_ERRORS as e:
+            raise OSError(errno.EIO, 'corrupt {} data ({})'.format(name, e),
+                          file_name) from e
+        return
+    yield from search_stream(regex, f)
+
+
+def is_binary(file_name, sample_size=BINARY_SAMPLE):
+    """Guess like grep does: a NUL byte in the first block means binary.
+
+    Compressed files are judged by their decompressed content.
+    """
+    with open(file_name, 'rb') as f:
+        name = compression(f)
+        if name is None:
+            return b'\0' in f.read(sample_size)
+        try:
+            with decompressed(f, name) as stream:
+                return b'\0' in stream.read(sample_size)
+        except DECOMPRESS_ERRORS:
+            return True
+
+
+def is_compressed(file_name):
+    """Return True if file_name holds data in one of the MAGIC formats."""
+    try:
+        with open(file_name, 'rb') as f:
+            return compression(f) is not None
+    except OSError:
+        return False
+
+
+def grep_file(regex, file_name, skip_binary=False, max_count=None,
+              count_only=False, lazy=False):
+    """Search one file and return its result.
+
+    Returns None when skip_binary is set and the file looks binary. With
+    count_only the result is the number of matching lines, otherwise the
+    (line_number, line) matches: a list, or the search generator itself
+    when lazy is set so the caller can stream it. Reading stops as soon
+    as max_count matching lines have been found.
+    """
+    if skip_binary and file_name != '-' and is_binary(file_name):
+        return None
+    matches = search_file(regex, file_name)
+    if max_count is not None:
+        matches = islice(matches, max_count)
+    if count_only:
+        return sum(1 for _ in matches)
+    return matches if lazy else list(matches)
+
+
+def _grep_task(task):
+    """Grep one file, returning errors instead of raising them."""
+    regex, file_name, options = task
+    try:
+        return file_name, grep_file(regex, file_name, *options), None
+    except OSError as e:
+        return file_name, None, e
+
+
+def iter_files(paths, recursive=False, exclude_dirs=EXCLUDE_DIRS):
+    """Yield the files to search, in a deterministic order.
+
+    Without recursive, paths are yielded as given. With it, directories
+    are walked depth first in sorted order, skipping exclude_dirs and
+    symlinks found along the way, like grep -r.
+    """
+    for path in paths:
+        if recursive and path != '-' and os.path.isdir(path):
+            yield from _walk_sorted(path, exclude_dirs)
+        else:
+            yield path
+
+
+def _walk_sorted(top, exclude_dirs):
+    try:
+        with os.scandir(top) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+    except OSError as e:
+        print('grep.py: {}: {}'.format(top, e.strerror), file=sys.stderr)
+        return
+    for entry in entries:
+        if entry.is_symlink():
+            continue
+        if entry.is_dir():
+            if entry.name not in exclude_dirs:
+                yield from _walk_sorted(entry.path, exclude_dirs)
+        elif entry.is_file():
+            yield entry.path
+
+
+def run_grep(regex, files, workers=1, skip_binary=False, max_count=None,
+             count_only=False):
+    """Yield (file_name, result, error) for files, in the order given.
+
+    result is what grep_file() returns. Serially, line results are lazy
+    generators, so output streams while the file is read and errors can
+    also surface while iterating. With workers > 1 the files are searched
+    in a process pool and each result arrives whole; Pool.imap hands them
+    back in input order, so output never interleaves.
+    """
+    if workers <= 1:
+        options = (skip_binary, max_count, count_only, True)
+        for file_name in files:
+            yield _grep_task((regex, file_name, options))
+        return
+    options = (skip_binary, max_count, count_only, False)
+    tasks = ((regex, file_name, options) for file_name in files)
+    with Pool(workers) as pool:
+        yield from pool.imap(_grep_task, tasks, chunksize=8)
 
 
 def grep_py(args):
     """Searches for pattern in files given on commandline
     and prints matches to standard out.
 
+    Returns 0 when something matched and 1 otherwise, like grep.
+
     Args:
         args: commandline arguments.
     """
 
+    parser = argparse.ArgumentParser(prog=args[0], description=__doc__)
+    parser.add_argument('pattern', nargs='?')
+    parser.add_argument('files', nargs='*')
+    parser.add_argument('-r', '--recursive', action='store_true',
+                        help='search directories recursively, skipping '
+                             'binary files')
+    parser.add_argument('-j', '--jobs', type=int, default=cpu_count(),
+                        help='worker processes for -r (default: %(default)s)')
+    parser.add_argument('--exclude-dir', action='append', default=[],
+                        metavar='NAME', help='directory name to skip with -r '
+                        '(in addition to {})'.format(', '.join(EXCLUDE_DIRS)))
+    parser.add_argument('-l', '--files-with-matches', action='store_true',
+                        help='print only the names of files that match')
+    parser.add_argument('-c', '--count', action='store_true',
+                        help='print only the number of matching lines')
+    parser.add_argument('-m', '--max-count', type=int, metavar='N',
+                        help='stop reading a file after N matching lines')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='print nothing; exit 0 on the first match')
+    parser.add_argument('-F', '--fixed-strings', action='store_true',
+                        help='patterns are literal strings, not regexes')
+    parser.add_argument('-f', '--file', dest='pattern_file', metavar='FILE',
+                        help='read patterns from FILE, one per line; every '
+                             'positional argument is then a file to search')
+    parser.add_argument('--index', metavar='FILE',
+                        help='skip files that a trigram index built by '
+                             'grep_index.py rules out')
+    options = parser.parse_args(args[1:])
+    if options.pattern_file is not None:
+        if options.pattern is not None:
+            options.files.insert(0, options.pattern)
+    elif options.pattern is None:
+        parser.error('the following arguments are required: pattern')
+    paths = options.files or (['.'] if options.recursive else ['-'])
+    exclude_dirs = EXCLUDE_DIRS | set(options.exclude_dir)
+
+    # -l and -q only need to know whether a file matches at all.
+    max_count = options.max_count
+    if options.files_with_matches or options.quiet:
+        max_count = 1
+    count_only = options.count or options.files_with_matches or options.quiet
+
+    status = 1
     try:
-        search_string = args[1]
-        with fileinput.input(args[2:]) as infile:
-            matches = [(infile.filename(), infile.filelineno(), line)
-                       for line in infile
-                       if re.search(search_string, line, re.IGNORECASE)]
-
-        if len(args[2:]) > 1:
-            for file_name, line_number, line in matches:
-                print('{file_name}: ({number}):   {match}'.format(
-                    file_name=file_name,
-                    number=line_number,
-                    match=line),
-                    end='')
+        if options.pattern_file is not None:
+            patterns = read_patterns(options.pattern_file)
         else:
-            print(*matches, sep='')
-    except FileNotFoundError:
+            patterns = [options.pattern]
+        pattern_set = PatternSet(patterns, options.fixed_strings)
+        regex = pattern_set.regex
+        # With several patterns each line is tagged with the one that hit.
+        tag = len(patterns) > 1
+        out = sys.stdout.buffer
+        many = len(paths) > 1 or options.recursive
+        # Files named on the command line are searched lazily in order, so
+        # large ones stream. -r searches in a process pool, and so do
+        # several named files when each result is just a count (-c, -l,
+        # -q) or when decompressing them is most of the work.
+        workers = 1
+        if options.recursive:
+            workers = options.jobs
+        elif many and '-' not in paths and (
+                count_only or sum(map(is_compressed, paths)) > 1):
+            workers = min(options.jobs, len(paths))
+        files = iter_files(paths, options.recursive, exclude_dirs)
+        if options.index is not None:
+            from grep_index import TrigramIndex, pattern_query
+            index = TrigramIndex(options.index)
+            files = index.filter(files, pattern_query(pattern_set))
+        results = run_grep(regex, files, workers, options.recursive,
+                           max_count, count_only)
+        for file_name, result, error in results:
+            prefix = os.fsencode(file_name)
+            try:
+                if error is not None:
+                    raise error
+                if result is None:
+                    continue
+                if not count_only:
+                    for line_number, line in result:
+                        status = 0
+                        if tag:
+                            hit = pattern_set.patterns[pattern_set.which(line)]
+                            line = b'[%s] %s' % (hit, line)
+                        if many:
+                            out.write(b'%s: (%d):   %s' % (prefix, line_number,
+                                                           line))
+                        else:
+                            out.write(line)
+                elif options.quiet:
+                    if result:
+                        results.close()
+                        return 0
+                elif options.files_with_matches:
+                    if result:
+                        status = 0
+                        out.write(prefix + b'\n')
+                else:
+                    status = 0 if result else status
+                    if many:
+                        out.write(b'%s:%d\n' % (prefix, result))
+                    else:
+                        out.write(b'%d\n' % result)
+            except OSError as e:
+                # A missing file named on the command line ends the search,
+                # anything else (unreadable, corrupt) is reported and skipped.
+                if (isinstance(e, BrokenPipeError) or not options.recursive
+                        and isinstance(e, FileNotFoundError)):
+                    raise
+                print('{}: {}: {}'.format(args[0], file_name,
+                                          e.strerror or e),
+                      file=sys.stderr)
+            out.flush()
+    except FileNotFoundError as e:
         print('{program_name}: {file_name}: No such file or directory'.format(
             program_name=args[0],
-            file_name=args[2]
+            file_name=e.filename
             ))
         sys.exit(-2)
+    except BrokenPipeError:
+        # The reader went away (grep ... | head); stop quietly.
+        sys.stdout = None
     except KeyboardInterrupt:
         sys.exit(-3)
+    return status
 
 
 if __name__ == '__main__':
-    if len(sys.argv) > 2:
+    if len(sys.argv) > 1:
         sys.exit(grep_py(sys.argv))
     else:
         sys.exit(-1)
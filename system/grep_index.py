@@ -0,0 +1,453 @@
+#! /usr/bin/env python3
+"""Build and query an on-disk trigram index for grep.py.
+
+The index records, for every three-byte sequence in a corpus, which
+files contain it. A query is turned into the trigrams any match must
+contain (as an OR of ANDs, following the codesearch approach), the
+posting lists narrow the corpus down to the files that have them, and
+only those files are searched with the real regex.
+
+Text is indexed lowercased, because grep.py matches case-insensitively,
+and trigrams spanning a newline are left out, because grep.py matches
+single lines. Binary and corrupt files are not indexed, so they are
+always searched.
+
+The index is a single file: a JSON header with the roots, the
+(path, size, mtime_ns) of each file and of each file left out, followed
+by the sorted trigrams, their offsets and the posting lists, which are
+mmap'd and read in place. Rebuilding an existing index only reads files
+whose size or mtime changed and carries the postings of the others over.
+
+    grep_index.py INDEX ROOT...     build or update INDEX for ROOTs
+    grep_index.py INDEX             update INDEX for its recorded roots
+    grep.py --index INDEX -r PATTERN ROOT...
+"""
+
+import argparse
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+from grep import (BINARY_SAMPLE, BLOCK_SIZE, DECOMPRESS_ERRORS, EXCLUDE_DIRS,
+                  compression, decompressed, iter_files)
+from parallel_hash import DEFAULT_WORKERS, hash_paths
+
+MAGIC = b'GRPTRI1\n'
+HEADER = struct.Struct('<QQQ')
+
+# Queries are OR-of-AND clauses; past this many clauses a constraint is
+# dropped, which only widens the candidate set.
+MAX_CLAUSES = 64
+
+# Matches every file: a single clause that requires no trigram.
+MATCH_ALL = frozenset((frozenset(),))
+
+_TRIGRAM = re.compile(b'...', re.DOTALL)
+
+# Parser opcodes of the repeats; POSSESSIVE_REPEAT is new in Python 3.11.
+_REPEATS = tuple(getattr(sre_parse, name)
+                 for name in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT')
+                 if hasattr(sre_parse, name))
+
+
+def _align(offset, size=8):
+    return -(-offset // size) * size
+
+
+def text_trigrams(text):
+    """Return the set of trigram keys in text (already lowercased).
+
+    The three passes over staggered offsets together see every position,
+    and re.findall does the slicing in C. Trigrams with a newline in them
+    are dropped.
+    """
+    trigrams = set()
+    for shift in range(3):
+        trigrams.update(_TRIGRAM.findall(text, shift))
+    return {int.from_bytes(trigram, 'big') for trigram in trigrams
+            if b'\n' not in trigram}
+
+
+def file_trigrams(path, block_size=BLOCK_SIZE):
+    """Return the sorted trigram keys of path as an array, None if binary.
+
+    Compressed files are indexed by their decompressed content, as
+    grep.py searches them. Corrupt or truncated ones (say a rotated log
+    still being written) also give None: they stay out of the index and
+    are always searched.
+    """
+    keys = set()
+    with open(path, 'rb') as f:
+        name = compression(f)
+        stream = decompressed(f, name) if name is not None else f
+        with stream:
+            tail = b''
+            first = True
+            while True:
+                try:
+                    block = stream.read(block_size)
+                except DECOMPRESS_ERRORS:
+                    return None
+                except OSError as e:
+                    # Decompressors report bad data (a gzip header, a bz2
+                    # stream) as OSErrors without an errno; real read
+                    # errors have one and are raised.
+                    if name is None or e.errno is not None:
+                        raise
+                    return None
+                if not block:
+                    break
+                if first and b'\0' in block[:BINARY_SAMPLE]:
+                    return None
+                first = False
+                buf = tail + block.lower()
+                keys |= text_trigrams(buf)
+                tail = buf[-2:]
+    return array('I', sorted(keys))
+
+
+# What _index_keys() gives for a file file_trigrams() leaves out, since
+# hash_paths() drops None results.
+SKIPPED = 'skipped'
+
+
+def _index_keys(path):
+    keys = file_trigrams(path)
+    return SKIPPED if keys is None else keys
+
+
+def _and(left, right):
+    if left == MATCH_ALL:
+        return right
+    if right == MATCH_ALL:
+        return left
+    both = frozenset(a | b for a in left for b in right)
+    if len(both) > MAX_CLAUSES:
+        return left if len(left) <= len(right) else right
+    return both
+
+
+def _or(left, right):
+    either = left | right
+    if frozenset() in either or len(either) > MAX_CLAUSES:
+        return MATCH_ALL
+    return either
+
+
+def literal_query(literal):
+    """Return the query matching files that contain literal."""
+    keys = text_trigrams(literal.lower())
+    return frozenset((frozenset(keys),))
+
+
+def _sequence_query(items):
+    """Return (query, literal) for a parsed regex sequence.
+
+    literal is the bytes the sequence always matches when it is made of
+    literals only (zero-width assertions allowed), otherwise None.
+    """
+    query = MATCH_ALL
+    run = bytearray()
+    pure = True
+    for op, av in items:
+        if op is sre_parse.LITERAL:
+            run.append(av)
+            continue
+        if op is sre_parse.AT:
+            # Anchors match no bytes, so literals on both sides are
+            # still adjacent.
+            continue
+        sub = None
+        if op is sre_parse.SUBPATTERN:
+            sub, literal = _sequence_query(av[-1])
+            if literal is not None:
+                run += literal
+                continue
+        elif op is getattr(sre_parse, 'ATOMIC_GROUP', None):
+            sub, literal = _sequence_query(av)
+            if literal is not None:
+                run += literal
+                continue
+        elif op is sre_parse.BRANCH:
+            sub = frozenset()
+            for branch in av[1]:
+                sub = _or(sub, _sequence_query(branch)[0])
+        elif op in _REPEATS and av[0] >= 1:
+            sub = _sequence_query(av[2])[0]
+        pure = False
+        query = _and(query, literal_query(bytes(run)))
+        run.clear()
+        if sub is not None:
+            query = _and(query, sub)
+    query = _and(query, literal_query(bytes(run)))
+    return query, bytes(run) if pure else None
+
+
+def regex_query(pattern):
+    """Return the trigram query for a bytes regex, as grep.py compiles it."""
+    parsed = sre_parse.parse(pattern, re.IGNORECASE | re.MULTILINE)
+    return _sequence_query(parsed)[0]
+
+
+def pattern_query(pattern_set):
+    """Return the trigram query for a grep.PatternSet."""
+    query = frozenset()
+    for pattern in pattern_set.patterns:
+        sub = (literal_query(pattern) if pattern_set.fixed
+               else regex_query(pattern))
+        query = _or(query, sub)
+    return query
+
+
+class TrigramIndex:
+    """A trigram index file, mmap'd for reading.
+
+    Example:
+        with TrigramIndex(path) as index:
+            paths = list(index.filter(paths, pattern_query(pattern_set)))
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            self._mm.close()
+            raise ValueError('{}: not a trigram index'.format(path))
+        pos = len(MAGIC)
+        meta_size, count, npostings = HEADER.unpack_from(self._mm, pos)
+        pos += HEADER.size
+        meta = json.loads(self._mm[pos:pos + meta_size])
+        self.roots = meta['roots']
+        self.exclude_dirs = meta['exclude_dirs']
+        self.files = meta['files']
+        # Files read but left out, so an update need not read them again.
+        self.skipped = meta.get('skipped', [])
+        self._ids = {path: i for i, (path, _, _) in enumerate(self.files)}
+        view = memoryview(self._mm)
+        pos = _align(pos + meta_size)
+        self._trigrams = view[pos:pos + 4 * count].cast('I')
+        pos = _align(pos + 4 * count)
+        self._offsets = view[pos:pos + 8 * (count + 1)].cast('Q')
+        pos += 8 * (count + 1)
+        self._postings = view[pos:pos + 4 * npostings].cast('I')
+        view.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for view in (self._trigrams, self._offsets, self._postings):
+            view.release()
+        self._mm.close()
+
+    def __len__(self):
+        return len(self.files)
+
+    def posting(self, key):
+        """Return the ids of the files containing trigram key.
+
+        The result is a memoryview into the index; release it before
+        close().
+        """
+        i = bisect_left(self._trigrams, key)
+        if i == len(self._trigrams) or self._trigrams[i] != key:
+            return self._postings[0:0]
+        return self._postings[self._offsets[i]:self._offsets[i + 1]]
+
+    def iter_postings(self):
+        """Yield (trigram key, file ids) for every trigram.
+
+        Each ids memoryview is released once the next pair is requested.
+        """
+        offsets = self._offsets
+        for i, key in enumerate(self._trigrams):
+            with self._postings[offsets[i]:offsets[i + 1]] as ids:
+                yield key, ids
+
+    def candidates(self, query):
+        """Return the ids of the files that can match query."""
+        found = set()
+        for clause in query:
+            if not clause:
+                return set(range(len(self.files)))
+            postings = sorted((self.posting(key) for key in clause), key=len)
+            ids = set(postings[0])
+            for posting in postings[1:]:
+                if not ids:
+                    break
+                ids.intersection_update(posting)
+            for posting in postings:
+                posting.release()
+            found |= ids
+        return found
+
+    def filter(self, paths, query):
+        """Yield the paths that may match query.
+
+        A path is only dropped when it is indexed, unchanged since, and
+        lacks the trigrams; anything else is searched as usual.
+        """
+        ids = self.candidates(query)
+        for path in paths:
+            i = self._ids.get(os.path.abspath(path)) if path != '-' else None
+            if i is None or i in ids:
+                yield path
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                yield path
+                continue
+            _, size, mtime_ns = self.files[i]
+            if (st.st_size, st.st_mtime_ns) != (size, mtime_ns):
+                yield path
+
+
+def build_index(index_path, roots=None, exclude_dirs=EXCLUDE_DIRS,
+                workers=DEFAULT_WORKERS):
+    """Build index_path for the files under roots, or bring it up to date.
+
+    With an existing index, roots and exclude_dirs default to the
+    recorded ones and only new or modified files are read, binary and
+    corrupt ones included. Returns (files indexed, files read).
+    """
+    old = TrigramIndex(index_path) if os.path.exists(index_path) else None
+    try:
+        if roots is None:
+            if old is None:
+                raise ValueError('{}: no index to update'.format(index_path))
+            roots = old.roots
+            exclude_dirs = old.exclude_dirs
+        roots = [os.path.abspath(root) for root in roots]
+
+        stats = {}
+        for path in iter_files(roots, True, frozenset(exclude_dirs)):
+            try:
+                stats[path] = os.stat(path)
+            except OSError:
+                pass
+
+        def unchanged(path, size, mtime_ns):
+            st = stats.get(path)
+            return st is not None and (st.st_size, st.st_mtime_ns) == (
+                size, mtime_ns)
+
+        # Unchanged files keep their postings under a new id.
+        kept = {}
+        kept_skipped = set()
+        if old is not None:
+            for path, size, mtime_ns in old.files:
+                if unchanged(path, size, mtime_ns):
+                    kept[path] = old._ids[path]
+            for path, size, mtime_ns in old.skipped:
+                if unchanged(path, size, mtime_ns):
+                    kept_skipped.add(path)
+        fresh = hash_paths([path for path in stats
+                            if path not in kept and path not in kept_skipped],
+                           _index_keys, workers, processes=True,
+                           sizes={path: st.st_size
+                                  for path, st in stats.items()})
+
+        files = []
+        skipped = []
+        remap = {}
+        new_keys = []
+        for path in sorted(stats):
+            st = stats[path]
+            record = (path, st.st_size, st.st_mtime_ns)
+            if path in kept:
+                remap[kept[path]] = len(files)
+            elif path in kept_skipped or fresh.get(path) == SKIPPED:
+                skipped.append(record)
+                continue
+            elif path in fresh:
+                new_keys.append((len(files), fresh[path]))
+            else:
+                continue
+            files.append(record)
+
+        postings = defaultdict(lambda: array('I'))
+        if old is not None:
+            for key, ids in old.iter_postings():
+                moved = [remap[i] for i in ids if i in remap]
+                if moved:
+                    postings[key].extend(moved)
+        for file_id, keys in new_keys:
+            for key in keys:
+                postings[key].append(file_id)
+    finally:
+        if old is not None:
+            old.close()
+
+    _write_index(index_path, roots, exclude_dirs, files, postings, skipped)
+    return len(files), len(fresh)
+
+
+def _write_index(index_path, roots, exclude_dirs, files, postings,
+                 skipped=()):
+    """Write the index to a temporary file and move it into place."""
+    meta = json.dumps({'roots': roots, 'exclude_dirs': sorted(exclude_dirs),
+                       'files': files, 'skipped': list(skipped)}).encode()
+    keys = array('I', sorted(postings))
+    offsets = array('Q', [0])
+    for key in keys:
+        offsets.append(offsets[-1] + len(postings[key]))
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(HEADER.pack(len(meta), len(keys), offsets[-1]))
+        f.write(meta)
+        f.write(b'\0' * (_align(f.tell()) - f.tell()))
+        keys.tofile(f)
+        f.write(b'\0' * (_align(f.tell()) - f.tell()))
+        offsets.tofile(f)
+        for key in keys:
+            ids = postings[key]
+            array('I', sorted(ids)).tofile(f)
+    os.replace(tmp_path, index_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build or update a trigram index for grep.py --index.')
+    parser.add_argument('index', help='index file to create or update')
+    parser.add_argument('roots', nargs='*',
+                        help='directories to index (default: the roots the '
+                             'index was built for)')
+    parser.add_argument('--exclude-dir', action='append', default=[],
+                        metavar='NAME', help='directory name to skip '
+                        '(in addition to {})'.format(', '.join(EXCLUDE_DIRS)))
+    parser.add_argument('-j', '--workers', type=int, default=DEFAULT_WORKERS,
+                        help='processes reading files (default: %(default)s)')
+    args = parser.parse_args()
+
+    if args.roots:
+        indexed, read = build_index(args.index, args.roots,
+                                    EXCLUDE_DIRS | set(args.exclude_dir),
+                                    args.workers)
+    else:
+        try:
+            indexed, read = build_index(args.index, workers=args.workers)
+        except ValueError as e:
+            parser.error(str(e))
+    print('{}: {} files indexed, {} read'.format(args.index, indexed, read),
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Microbenchmark: MB/s of the old hashing loops against fast_hash.
+
+Usage: python hash_bench.py [file ...]
+
+Without arguments a temporary file of each size in SIZES is generated.
+Run it twice so the second pass measures a warm page cache.
+"""
+
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+import xxhash
+
+import fast_hash
+from duplicate_file_finder import hashfile
+
+SIZES = (1 << 20, 16 << 20, 256 << 20)
+
+
+def chunk_reader(fobj, chunk_size=1024):
+    """The generator find_duplicate_files.get_hash() used to read with."""
+    while True:
+        chunk = fobj.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def old_chunk_reader_hash(path):
+    """find_duplicate_files.get_hash() before fast_hash: 1 KiB reads."""
+    hashobj = xxhash.xxh64()
+    with open(path, 'rb') as f:
+        for chunk in chunk_reader(f):
+            hashobj.update(chunk)
+    return hashobj.hexdigest()
+
+
+def old_hashfile(path, blocksize=65536):
+    """duplicate_file_finder.hashfile() before fast_hash: 64 KiB reads."""
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as afile:
+        buf = afile.read(blocksize)
+        while len(buf) > 0:
+            hasher.update(buf)
+            buf = afile.read(blocksize)
+    return hasher.hexdigest()
+
+
+CONTENDERS = [
+    ('xxh64, 1 KiB reads', old_chunk_reader_hash),
+    ('xxh64, fast_hash', lambda path: fast_hash.hash_file(path, xxhash.xxh64)),
+    ('xxh64, mmap', lambda path: fast_hash.hash_file(path, xxhash.xxh64,
+                                                      mmap_threshold=0)),
+    ('sha1, 64 KiB reads', old_hashfile),
+    ('sha1, fast_hash', hashfile),
+]
+
+
+def bench(path, repeat=3):
+    size = os.path.getsize(path)
+    print('{} ({:.1f} MiB)'.format(path, size / (1 << 20)))
+    for name, func in CONTENDERS:
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func(path)
+            best = min(best, time.perf_counter() - start)
+        print('    {:<20} {:>9.1f} MB/s'.format(name, size / best / 1e6))
+
+
+def main(paths):
+    if paths:
+        for path in paths:
+            bench(path)
+        return
+    for size in SIZES:
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(os.urandom(size))
+            f.flush()
+            bench(f.name)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,151 @@
+"""Persistent SQLite cache of file digests for repeated duplicate scans.
+
+Entries are keyed by (st_dev, st_ino, kind), where kind names the digest
+(for example 'full:xxh64' or 'head:xxh64:1024:0'), and are only trusted
+while the file's size and st_mtime_ns still match. A second scan of an
+unchanged tree therefore reads none of the candidates. find_duplicate_files
+checks entries against the stat results of its directory walk, so the
+cache adds no stat calls; callers without them can leave hash_paths() to
+stat each file.
+"""
+
+import os
+import sqlite3
+import time
+
+from parallel_hash import hash_paths
+
+DEFAULT_PATH = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'toolbox', 'hashes.sqlite3')
+
+# prune() evicts entries that no scan has looked up for this many seconds.
+MAX_AGE = 30 * 24 * 3600
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS hashes (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    path TEXT NOT NULL,
+    seen INTEGER NOT NULL,
+    PRIMARY KEY (dev, ino, kind)
+) WITHOUT ROWID
+'''
+
+
+class HashCache:
+    """On-disk digest cache, used as a context manager.
+
+    Example:
+        with HashCache() as cache:
+            digests = cache.hash_paths(paths, get_hash, 'full:xxh64')
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        # Paths actually read by the last hash_paths() call.
+        self.last_hashed = []
+        self._db = sqlite3.connect(path)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(SCHEMA)
+        self._now = int(time.time())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+    def lookup(self, st, kind):
+        """Return the cached digest for a stat result, or None if stale."""
+        row = self._db.execute(
+            'SELECT size, mtime_ns, digest FROM hashes '
+            'WHERE dev = ? AND ino = ? AND kind = ?',
+            (st.st_dev, st.st_ino, kind)).fetchone()
+        if row is None or row[0] != st.st_size or row[1] != st.st_mtime_ns:
+            return None
+        return row[2]
+
+    def store(self, entries, kind):
+        """Insert or replace (path, stat_result, digest) entries."""
+        self._db.executemany(
+            'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [(st.st_dev, st.st_ino, kind, st.st_size, st.st_mtime_ns,
+              digest, path, self._now) for path, st, digest in entries])
+        self._db.commit()
+
+    def hash_paths(self, paths, hash_func, kind, stats=None, **kwargs):
+        """Like parallel_hash.hash_paths(), but served from the cache.
+
+        Only files whose cached entry is missing or stale are hashed; the
+        new digests are stored before returning. stats optionally maps
+        path to an os.stat_result the caller already has. Extra keyword
+        arguments are passed on to parallel_hash.hash_paths().
+        """
+        digests = {}
+        misses = {}
+        touched = []
+        for path in paths:
+            try:
+                st = stats[path] if stats and path in stats else os.stat(path)
+            except OSError:
+                continue
+            digest = self.lookup(st, kind)
+            if digest is None:
+                misses[path] = st
+            else:
+                digests[path] = digest
+                touched.append((st.st_dev, st.st_ino, kind))
+        self.hits += len(digests)
+        self.misses += len(misses)
+
+        if touched:
+            self._db.executemany(
+                'UPDATE hashes SET seen = {} '
+                'WHERE dev = ? AND ino = ? AND kind = ?'.format(self._now),
+                touched)
+        self.last_hashed = list(misses)
+        fresh = hash_paths(misses, hash_func, **kwargs)
+        self.store([(path, misses[path], digest)
+                    for path, digest in fresh.items()], kind)
+        digests.update(fresh)
+        return digests
+
+    def prune(self, max_age=MAX_AGE):
+        """Evict stale entries and return how many were removed.
+
+        An entry goes when its path no longer exists, now belongs to a
+        different inode, or has not been looked up for max_age seconds.
+        """
+        cutoff = self._now - max_age
+        doomed = []
+        rows = self._db.execute(
+            'SELECT dev, ino, kind, path, seen FROM hashes').fetchall()
+        for dev, ino, kind, path, seen in rows:
+            if seen < cutoff:
+                doomed.append((dev, ino, kind))
+                continue
+            try:
+                st = os.stat(path, follow_symlinks=False)
+            except OSError:
+                doomed.append((dev, ino, kind))
+                continue
+            if (st.st_dev, st.st_ino) != (dev, ino):
+                doomed.append((dev, ino, kind))
+        self._db.executemany(
+            'DELETE FROM hashes WHERE dev = ? AND ino = ? AND kind = ?', doomed)
+        self._db.commit()
+        return len(doomed)
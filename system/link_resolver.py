@@ -0,0 +1,140 @@
+"""Memoized symlink resolution for scanning large link farms.
+
+Link farms hold thousands of symlinks that point into the same few
+directories, often through further links (stow/current -> pkg-1.2).
+LinkResolver walks a path one component at a time like the kernel does,
+but remembers the outcome for every directory and every link it passes
+through, so a shared prefix or hop is lstat'ed and readlink'ed once per
+scan rather than once per link.
+
+Each outcome is OK, BROKEN (a component is missing or not a directory)
+or LOOP (the chain comes back on itself, or takes more than max_hops
+links, which the kernel reports as ELOOP as well).
+"""
+
+import os
+import stat
+
+# Links followed in one lookup before giving up, as Linux's MAXSYMLINKS.
+MAX_HOPS = 40
+
+OK = 'ok'
+BROKEN = 'broken'
+LOOP = 'loop'
+
+
+class LinkResolver:
+    """Resolve paths with a cache shared across lookups.
+
+    A resolution is a (status, real_path, is_dir, hops) tuple, where
+    real_path is the path with every link resolved (None unless status
+    is OK) and hops is the number of links followed to get there.
+    The cache trusts the filesystem not to change during a scan; use a
+    new resolver for each scan.
+    """
+
+    def __init__(self, max_hops=MAX_HOPS):
+        self.max_hops = max_hops
+        # lstat() and readlink() calls made, for comparing scans.
+        self.syscalls = 0
+        self._paths = {}
+        self._leaves = {}
+
+    def resolve(self, path):
+        """Return the resolution of path, relative to the cwd if needed."""
+        if not os.path.isabs(path):
+            path = os.path.join(os.getcwd(), path)
+        return self._resolve(path, set())
+
+    def status(self, path):
+        """Return OK, BROKEN or LOOP for path, as os.stat() would see it."""
+        return self.resolve(path)[0]
+
+    def link_status(self, path):
+        """Like status() for a path already known to be a symlink.
+
+        Saves the lstat() of the link itself, for callers that got its
+        type from os.scandir().
+        """
+        if not os.path.isabs(path):
+            path = os.path.join(os.getcwd(), path)
+        parent, name = os.path.split(path)
+        active = set()
+        up = self._resolve(parent, active)
+        if up[0] != OK:
+            return up[0]
+        if not up[2]:
+            return BROKEN
+        real = os.path.join(up[1], name)
+        return self._hop(self._leaf(real, active, True), up[3])[0]
+
+    def _resolve(self, path, active):
+        result = self._paths.get(path)
+        if result is not None:
+            return result
+        parent, name = os.path.split(path)
+        if parent == path:
+            result = (OK, path, True, 0)
+        elif not name:
+            # A trailing separator: the path must be a directory.
+            result = self._resolve(parent, active)
+            if result[0] == OK and not result[2]:
+                result = (BROKEN, None, False, result[3])
+        else:
+            up = self._resolve(parent, active)
+            if up[0] != OK:
+                result = up
+            elif not up[2]:
+                result = (BROKEN, None, False, up[3])
+            elif name == '.':
+                result = up
+            elif name == '..':
+                result = (OK, os.path.dirname(up[1]), True, up[3])
+            else:
+                leaf = self._leaf(os.path.join(up[1], name), active)
+                result = self._hop(leaf, up[3])
+        self._paths[path] = result
+        return result
+
+    def _leaf(self, real, active, is_link=False):
+        """Resolve real, whose parent directory is already resolved."""
+        result = self._leaves.get(real)
+        if result is not None:
+            return result
+        try:
+            if not is_link:
+                self.syscalls += 1
+                mode = os.lstat(real).st_mode
+        except OSError:
+            result = (BROKEN, None, False, 0)
+        else:
+            if not is_link and not stat.S_ISLNK(mode):
+                result = (OK, real, stat.S_ISDIR(mode), 0)
+            elif real in active:
+                # Back at a link we are still resolving. Not cached: the
+                # outer lookup of real records the loop for the chain.
+                return (LOOP, None, False, 0)
+            else:
+                active.add(real)
+                try:
+                    self.syscalls += 1
+                    target = os.readlink(real)
+                    result = self._resolve(
+                        os.path.join(os.path.dirname(real), target), active)
+                except OSError:
+                    result = (BROKEN, None, False, 0)
+                finally:
+                    active.discard(real)
+                result = self._hop(result, 1)
+        self._leaves[real] = result
+        return result
+
+    def _hop(self, result, hops):
+        """Add hops to a resolution, turning it into LOOP past max_hops."""
+        if not hops or result[0] != OK:
+            return result
+        status, real, is_dir, total = result
+        total += hops
+        if total > self.max_hops:
+            return (LOOP, None, False, total)
+        return (status, real, is_dir, total)
@@ -0,0 +1,223 @@
+"""Find files that share most of their content, not just identical ones.
+
+Files are cut into content-defined chunks, so an insertion or deletion
+only changes the chunks around it and the rest still line up. The chunk
+digests are indexed and file pairs are ranked by how many bytes they
+share, which also gives an estimate of the achievable dedup ratio.
+
+The chunker uses a gear hash: every byte is mapped to a random 64-bit
+value, the hash is shifted left and the value added for each byte, so it
+covers the last WINDOW bytes, and a chunk ends where its top ANCHOR_BITS
+bits are all zero. The hash of a whole search range is computed with a
+handful of NumPy vector operations, so this module needs NumPy.
+"""
+
+import argparse
+import random
+from collections import defaultdict
+from itertools import combinations
+
+import xxhash
+
+try:
+    import numpy as np
+except ImportError as e:
+    raise ImportError('near_duplicates.py needs NumPy for chunking at C '
+                      'speed (pip install numpy)') from e
+
+from parallel_hash import DEFAULT_WORKERS, hash_paths
+from scan_tree import scan_files
+
+MIN_CHUNK = 2048
+MAX_CHUNK = 65536
+# A boundary is expected every 2**ANCHOR_BITS bytes past MIN_CHUNK.
+ANCHOR_BITS = 13
+BUFFER_SIZE = 8 << 20
+
+# Skip files smaller than this; they are a job for find_duplicate_files.
+MIN_FILE_SIZE = 1 << 20
+
+# Chunks found in more files than this (runs of zeros, common headers)
+# are counted for the dedup ratio but not paired up.
+MAX_FANOUT = 64
+
+
+# Bytes covered by the 64-bit gear hash.
+WINDOW = 64
+
+
+def _gear_table(seed=0x5eed):
+    """Map every byte value to a pseudo-random 64-bit value."""
+    rng = random.Random(seed)
+    return tuple(rng.getrandbits(64) for _ in range(256))
+
+
+GEAR = _gear_table()
+GEAR_ARRAY = np.array(GEAR, dtype=np.uint64)
+
+
+def find_cut(data, start, end, anchor_bits=ANCHOR_BITS):
+    """Return the offset just past the first boundary in data[start:end].
+
+    Returns None when there is none. The hash at each position covers the
+    WINDOW bytes ending there, so start must be at least WINDOW - 1.
+    """
+    mask = np.uint64(((1 << anchor_bits) - 1) << (64 - anchor_bits))
+    # Hash a few expected chunk lengths at a time, as a boundary usually
+    # comes long before end.
+    step = 2 << anchor_bits
+    for first in range(start, end, step):
+        last = min(first + step, end)
+        lo = first - (WINDOW - 1)
+        gear = GEAR_ARRAY[np.frombuffer(data, np.uint8, last - lo, lo)]
+        # After the step for span, each entry holds the hash of the
+        # 2 * span bytes ending there.
+        span = 1
+        while span < WINDOW:
+            gear[span:] += gear[:-span] << np.uint64(span)
+            span *= 2
+        hits = np.flatnonzero((gear[WINDOW - 1:] & mask) == 0)
+        if len(hits):
+            return first + int(hits[0]) + 1
+    return None
+
+
+def iter_chunks(fobj, min_size=MIN_CHUNK, max_size=MAX_CHUNK,
+                anchor_bits=ANCHOR_BITS, buffer_size=BUFFER_SIZE):
+    """Yield the content-defined chunks of a binary file as memoryviews.
+
+    Chunks are between min_size and max_size bytes long, except that the
+    last one may be shorter. Inserting a line into a log only changes the
+    chunks around it:
+
+    >>> import io
+    >>> rng = random.Random(1)
+    >>> log = b''.join(b'%d INFO worker-%d request id=%08x done\\n' % (
+    ...     i, rng.randrange(8), rng.getrandbits(32)) for i in range(100000))
+    >>> before = {bytes(c) for c in iter_chunks(io.BytesIO(log))}
+    >>> after = [bytes(c) for c in iter_chunks(io.BytesIO(b'new line\\n' + log))]
+    >>> sum(len(c) for c in after if c in before) / (len(log) + 9) > 0.95
+    True
+    """
+    # No boundary falls in the first WINDOW bytes of a chunk, so the hash
+    # never reaches back into the previous one.
+    min_size = max(min_size, WINDOW)
+    data = b''
+    eof = False
+    while not eof:
+        block = fobj.read(buffer_size)
+        eof = len(block) < buffer_size
+        data += block
+        view = memoryview(data)
+        pos = 0
+        while pos < len(data):
+            if not eof and len(data) - pos < max_size:
+                break
+            end = min(pos + max_size, len(data))
+            cut = None
+            if pos + min_size < end:
+                cut = find_cut(data, pos + min_size, end, anchor_bits)
+            cut = cut or end
+            yield view[pos:cut]
+            pos = cut
+        view.release()
+        data = data[pos:]
+
+
+def chunk_file(path, **kwargs):
+    """Return the (digest, length) pairs of the chunks of path."""
+    digest = xxhash.xxh64_intdigest
+    with open(path, 'rb') as f:
+        return [(digest(chunk), len(chunk)) for chunk in iter_chunks(f, **kwargs)]
+
+
+class ChunkIndex:
+    """Index of chunk digests across files."""
+
+    def __init__(self, max_fanout=MAX_FANOUT):
+        self.max_fanout = max_fanout
+        self.paths = []
+        self.sizes = []
+        self._files = defaultdict(set)
+        self._lengths = {}
+
+    def add(self, path, chunks):
+        """Add a file given the chunk_file() result for it."""
+        file_id = len(self.paths)
+        self.paths.append(path)
+        self.sizes.append(sum(length for _, length in chunks))
+        for digest, length in chunks:
+            self._files[digest].add(file_id)
+            self._lengths[digest] = length
+
+    def total_bytes(self):
+        return sum(self.sizes)
+
+    def unique_bytes(self):
+        """Bytes left if every repeated chunk were stored once."""
+        return sum(self._lengths.values())
+
+    def dedup_ratio(self):
+        unique = self.unique_bytes()
+        return self.total_bytes() / unique if unique else 1.0
+
+    def pairs(self, min_shared=1):
+        """Return (shared_bytes, path_a, path_b) tuples, most shared first.
+
+        Each distinct chunk common to both files counts once.
+        """
+        shared = defaultdict(int)
+        for digest, file_ids in self._files.items():
+            if len(file_ids) < 2 or len(file_ids) > self.max_fanout:
+                continue
+            length = self._lengths[digest]
+            for pair in combinations(sorted(file_ids), 2):
+                shared[pair] += length
+        ranked = [(nbytes, self.paths[a], self.paths[b])
+                  for (a, b), nbytes in shared.items() if nbytes >= min_shared]
+        ranked.sort(key=lambda item: item[0], reverse=True)
+        return ranked
+
+
+def find_near_duplicates(paths, min_file_size=MIN_FILE_SIZE, workers=1,
+                         max_fanout=MAX_FANOUT):
+    """Chunk every file of at least min_file_size under paths.
+
+    Returns the filled ChunkIndex. Files are chunked on workers threads.
+    """
+    files = {path: st.st_size
+             for path, st in scan_files(paths, workers=workers)
+             if st.st_size >= min_file_size}
+    chunks = hash_paths(files, chunk_file, workers=workers, sizes=files)
+    index = ChunkIndex(max_fanout)
+    for path in files:
+        if path in chunks:
+            index.add(path, chunks[path])
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Rank file pairs by shared content and estimate dedup.')
+    parser.add_argument('paths', nargs='+', help='directories to scan')
+    parser.add_argument('--min-file-size', type=int, default=MIN_FILE_SIZE,
+                        help='skip smaller files (default: %(default)s)')
+    parser.add_argument('--top', type=int, default=20,
+                        help='number of pairs to show (default: %(default)s)')
+    parser.add_argument('-j', '--workers', type=int, default=DEFAULT_WORKERS,
+                        help='concurrent chunking workers (default: %(default)s)')
+    args = parser.parse_args()
+
+    index = find_near_duplicates(args.paths, args.min_file_size, args.workers)
+    for shared, path_a, path_b in index.pairs()[:args.top]:
+        smaller = min(index.sizes[index.paths.index(path_a)],
+                      index.sizes[index.paths.index(path_b)])
+        print('{:>6.1%} {:>14,} bytes  {}  {}'.format(
+              shared / smaller if smaller else 0, shared, path_a, path_b))
+    print('{} files, {:,} bytes, {:,} unique: dedup ratio {:.2f}'.format(
+          len(index.paths), index.total_bytes(), index.unique_bytes(),
+          index.dedup_ratio()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Hash many files concurrently for the duplicate finders.
+
+hashlib and xxhash release the GIL while digesting large buffers, and
+file reads release it while waiting on the disk, so a thread pool keeps
+several reads in flight on NVMe and network mounts. A process pool is
+available for hash functions that hold the GIL.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+
+def _try_hash(hash_func, path):
+    """Return hash_func(path), or None when the file can't be read."""
+    try:
+        return hash_func(path)
+    except OSError:
+        return None
+
+
+def largest_first(paths, sizes=None):
+    """Return paths ordered by decreasing size.
+
+    Starting the biggest files first keeps the pool from idling behind
+    one large file at the end of the run. sizes maps path to size; paths
+    missing from it are stat'ed.
+    """
+    def size_of(path):
+        if sizes is not None and path in sizes:
+            return sizes[path]
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    return sorted(paths, key=size_of, reverse=True)
+
+
+def hash_paths(paths, hash_func, workers=1, processes=False, sizes=None):
+    """Return a {path: digest} dictionary for paths.
+
+    Args:
+        paths: files to hash.
+        hash_func: called with a path, returns its digest. Must be
+            picklable (a module-level function or functools.partial)
+            when processes is true.
+        workers: number of concurrent workers; 1 hashes serially in the
+            calling thread.
+        processes: use a process pool instead of a thread pool.
+        sizes: optional {path: size} used to schedule large files first.
+
+    Files that raise OSError are left out of the result, exactly as the
+    serial path leaves them out.
+    """
+    paths = list(paths)
+    if workers <= 1 or len(paths) < 2:
+        digests = zip(paths, map(_try_hash, repeat(hash_func), paths))
+        return {path: digest for path, digest in digests if digest is not None}
+
+    ordered = largest_first(paths, sizes)
+    if processes:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        chunksize = max(1, min(64, len(ordered) // (workers * 4)))
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+        chunksize = 1
+    with executor:
+        digests = executor.map(_try_hash, repeat(hash_func), ordered,
+                               chunksize=chunksize)
+        return {path: digest for path, digest in zip(ordered, digests)
+                if digest is not None}
@@ -0,0 +1,130 @@
+"""Replace verified duplicate files with hard links or reflinks.
+
+Every replacement is checked byte for byte against the file it will
+share storage with, created under a temporary name in the same
+directory, and then moved over the duplicate with os.replace(), so the
+duplicate's path never stops pointing at its content.
+"""
+
+import fcntl
+import os
+import shutil
+
+# ioctl request number of FICLONE from <linux/fs.h>.
+FICLONE = 0x40049409
+
+COMPARE_BLOCK_SIZE = 1 << 20
+
+
+def same_content(path1, path2, block_size=COMPARE_BLOCK_SIZE):
+    """Return True if the two files hold exactly the same bytes."""
+    buf1 = bytearray(block_size)
+    buf2 = bytearray(block_size)
+    with open(path1, 'rb', buffering=0) as f1, open(path2, 'rb', buffering=0) as f2:
+        while True:
+            n1 = f1.readinto(buf1)
+            n2 = f2.readinto(buf2)
+            if n1 != n2 or buf1[:n1] != buf2[:n2]:
+                return False
+            if not n1:
+                return True
+
+
+def _hardlink(source, duplicate, temp):
+    os.link(source, temp)
+
+
+def _reflink(source, duplicate, temp):
+    # A reflink is a file of its own, so it keeps the duplicate's owner,
+    # mode, times and extended attributes; chown first, as it can clear
+    # setuid bits.
+    st = os.stat(duplicate)
+    with open(source, 'rb') as src, open(temp, 'xb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            os.chown(temp, st.st_uid, st.st_gid)
+            shutil.copystat(duplicate, temp)
+        except BaseException:
+            os.remove(temp)
+            raise
+
+
+LINKERS = {'hardlink': _hardlink, 'reflink': _reflink}
+
+
+def reclaim_file(source, duplicate, mode='hardlink', dry_run=False,
+                 unlinked=None):
+    """Make duplicate share source's storage.
+
+    Returns (replaced, bytes_freed). Nothing is touched when the two
+    paths already share an inode, when the files are empty, when the
+    content differs, or when the duplicate changes while it is being
+    verified. Bytes only count as
+    freed once the duplicate's last other link is gone.
+
+    A dry run leaves every link count as it is, so unlinked, a dict
+    shared across calls, counts the links of each inode that would be
+    replaced; the last of them then counts as freeing the inode.
+    """
+    link = LINKERS[mode]
+    src_st = os.stat(source)
+    dup_st = os.stat(duplicate)
+    if (src_st.st_dev, src_st.st_ino) == (dup_st.st_dev, dup_st.st_ino):
+        return False, 0
+    if not dup_st.st_size:
+        # Nothing to free, and placeholder files shouldn't become one.
+        return False, 0
+    if not same_content(source, duplicate):
+        return False, 0
+    nlink = dup_st.st_nlink
+    if dry_run and unlinked is not None:
+        key = (dup_st.st_dev, dup_st.st_ino)
+        nlink -= unlinked.get(key, 0)
+        unlinked[key] = unlinked.get(key, 0) + 1
+    freed = dup_st.st_size if nlink == 1 else 0
+    if dry_run:
+        return True, freed
+
+    temp = os.path.join(os.path.dirname(duplicate),
+                        '.{}.{}.reclaim'.format(os.path.basename(duplicate),
+                                                os.getpid()))
+    # Set once link() has made temp: a file already there under that
+    # name is not ours to remove.
+    created = False
+    try:
+        link(source, duplicate, temp)
+        created = True
+        now = os.stat(duplicate)
+        if (now.st_ino, now.st_size, now.st_mtime_ns) != (
+                dup_st.st_ino, dup_st.st_size, dup_st.st_mtime_ns):
+            os.remove(temp)
+            return False, 0
+        os.replace(temp, duplicate)
+    except BaseException:
+        if created and os.path.lexists(temp):
+            os.remove(temp)
+        raise
+    return True, freed
+
+
+def reclaim_groups(groups, mode='hardlink', dry_run=False):
+    """Link every file in each group to the group's first file.
+
+    Returns (files_replaced, bytes_freed). Files that can't be linked
+    (for example across devices, or reflinks on a filesystem without
+    FICLONE) are reported and left alone.
+    """
+    replaced = freed = 0
+    unlinked = {}
+    for files in groups:
+        source = files[0]
+        for duplicate in files[1:]:
+            try:
+                done, saved = reclaim_file(source, duplicate, mode, dry_run,
+                                           unlinked)
+            except OSError as e:
+                print(f'Could not {mode} {duplicate}: {e}')
+                continue
+            replaced += done
+            freed += saved
+    return replaced, freed
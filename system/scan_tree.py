@@ -0,0 +1,117 @@
+"""os.scandir based directory walker that stats each file once.
+
+Directories are listed breadth-first. With workers > 1 several
+directories are listed (and their entries stat'ed) at the same time on a
+thread pool, but results are still consumed in the order the directories
+were discovered, so the output does not depend on the worker count.
+"""
+
+import os
+import stat
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ScanStats:
+    """Counters filled in by scan_files()."""
+
+    def __init__(self):
+        self.dirs = 0
+        self.files = 0
+        self.skipped = 0
+        self.errors = 0
+
+    def __repr__(self):
+        return ('ScanStats(dirs={}, files={}, skipped={}, errors={})'.format(
+                self.dirs, self.files, self.skipped, self.errors))
+
+    def tick(self):
+        """Called by scan_files() after each directory; a no-op here."""
+
+
+class _SerialExecutor:
+    """Stand-in for ThreadPoolExecutor that runs calls immediately."""
+
+    class _Done:
+        def __init__(self, value):
+            self._value = value
+
+        def result(self):
+            return self._value
+
+    def submit(self, func, *args):
+        return self._Done(func(*args))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+def walk_dirs(roots, list_dir, workers=1):
+    """Yield list_dir(path) for every directory under roots.
+
+    list_dir(path) must return a (result, subdirs) pair; result is
+    yielded and the subdirs are walked next. Directories are visited
+    breadth-first and results come out in discovery order.
+    """
+    executor = (ThreadPoolExecutor(max_workers=workers) if workers > 1
+                else _SerialExecutor())
+    with executor:
+        pending = deque(executor.submit(list_dir, root) for root in roots)
+        while pending:
+            result, subdirs = pending.popleft().result()
+            for subdir in subdirs:
+                pending.append(executor.submit(list_dir, subdir))
+            yield result
+
+
+def _list_regular_files(path):
+    """List one directory for scan_files().
+
+    Returns ((files, skipped, errors), subdirs) where files holds
+    (path, stat_result) pairs for the regular files. Symlinks, sockets,
+    devices and FIFOs are skipped; unreadable entries count as errors.
+    """
+    files = []
+    subdirs = []
+    skipped = errors = 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                        continue
+                    if entry.is_symlink():
+                        skipped += 1
+                        continue
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    errors += 1
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    files.append((entry.path, st))
+                else:
+                    skipped += 1
+    except OSError:
+        errors += 1
+    return (files, skipped, errors), subdirs
+
+
+def scan_files(roots, workers=1, stats=None):
+    """Yield (path, stat_result) for every regular file under roots.
+
+    Each file costs a single lstat, done through DirEntry.stat(). Pass a
+    ScanStats to collect directory, file, skip and error counts.
+    """
+    for files, skipped, errors in walk_dirs(roots, _list_regular_files,
+                                             workers):
+        if stats is not None:
+            stats.dirs += 1
+            stats.files += len(files)
+            stats.skipped += skipped
+            stats.errors += errors
+            stats.tick()
+        yield from files
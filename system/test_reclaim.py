@@ -0,0 +1,129 @@
+"""Tests for reclaim.py."""
+
+import errno
+import os
+
+import pytest
+
+import reclaim
+from reclaim import reclaim_file, reclaim_groups
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def inode(path):
+    st = os.stat(path)
+    return st.st_dev, st.st_ino
+
+
+def test_hardlinks_identical_files(tmp_path):
+    source = write(tmp_path / 'a', b'x' * 5000)
+    duplicate = write(tmp_path / 'b', b'x' * 5000)
+    assert reclaim_file(source, duplicate) == (True, 5000)
+    assert inode(source) == inode(duplicate)
+    assert read(duplicate) == b'x' * 5000
+    assert sorted(os.listdir(tmp_path)) == ['a', 'b']
+
+
+def test_leaves_different_content_alone(tmp_path):
+    source = write(tmp_path / 'a', b'x' * 5000)
+    duplicate = write(tmp_path / 'b', b'x' * 4999 + b'y')
+    assert reclaim_file(source, duplicate) == (False, 0)
+    assert inode(source) != inode(duplicate)
+    assert read(duplicate) == b'x' * 4999 + b'y'
+
+
+def test_skips_paths_sharing_an_inode(tmp_path):
+    source = write(tmp_path / 'a', b'x' * 5000)
+    duplicate = str(tmp_path / 'b')
+    os.link(source, duplicate)
+    assert reclaim_file(source, duplicate) == (False, 0)
+    assert os.stat(source).st_nlink == 2
+
+
+def test_skips_empty_files(tmp_path):
+    empty = [write(tmp_path / name, b'') for name in ('e1', 'e2', 'e3')]
+    assert reclaim_groups([empty]) == (0, 0)
+    assert len({inode(path) for path in empty}) == 3
+
+
+def test_leaves_duplicate_changed_during_verify(tmp_path, monkeypatch):
+    source = write(tmp_path / 'a', b'x' * 5000)
+    duplicate = write(tmp_path / 'b', b'x' * 5000)
+    same_content = reclaim.same_content
+
+    def same_then_rewrite(path1, path2):
+        result = same_content(path1, path2)
+        # Replaced by new content of the same size, like a save would.
+        write(tmp_path / 'new', b'z' * 5000)
+        os.replace(tmp_path / 'new', duplicate)
+        return result
+
+    monkeypatch.setattr(reclaim, 'same_content', same_then_rewrite)
+    assert reclaim_file(source, duplicate) == (False, 0)
+    assert read(duplicate) == b'z' * 5000
+    assert sorted(os.listdir(tmp_path)) == ['a', 'b']
+
+
+def test_keeps_a_temp_file_it_did_not_create(tmp_path):
+    source = write(tmp_path / 'a', b'x' * 5000)
+    duplicate = write(tmp_path / 'b', b'x' * 5000)
+    stray = write(tmp_path / '.b.{}.reclaim'.format(os.getpid()), b'stray')
+    with pytest.raises(FileExistsError):
+        reclaim_file(source, duplicate)
+    assert read(stray) == b'stray'
+    assert inode(source) != inode(duplicate)
+
+
+def test_dry_run_counts_inodes_linked_within_the_group(tmp_path):
+    source = write(tmp_path / 'src', b'x' * 5000)
+    first = write(tmp_path / 'a', b'x' * 5000)
+    os.link(first, tmp_path / 'b')
+    write(tmp_path / 'c', b'x' * 5000)
+    group = [source, first, str(tmp_path / 'b'), str(tmp_path / 'c')]
+
+    assert reclaim_groups([group], dry_run=True) == (3, 10000)
+    assert len({inode(path) for path in group}) == 3
+    assert reclaim_groups([group]) == (3, 10000)
+    assert len({inode(path) for path in group}) == 1
+
+
+def test_dry_run_frees_nothing_for_links_outside_the_group(tmp_path):
+    source = write(tmp_path / 'src', b'x' * 5000)
+    duplicate = write(tmp_path / 'a', b'x' * 5000)
+    os.link(duplicate, tmp_path / 'outside')
+    assert reclaim_groups([[source, duplicate]], dry_run=True) == (1, 0)
+    assert reclaim_groups([[source, duplicate]]) == (1, 0)
+
+
+def test_reflink_keeps_the_duplicates_metadata(tmp_path):
+    source = write(tmp_path / 'a', b'x' * 5000)
+    duplicate = write(tmp_path / 'b', b'x' * 5000)
+    os.chmod(source, 0o600)
+    os.chmod(duplicate, 0o640)
+    os.utime(duplicate, ns=(10 ** 18, 10 ** 18))
+    try:
+        done = reclaim_file(source, duplicate, mode='reflink')
+    except OSError as e:
+        if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV,
+                       errno.EINVAL):
+            # The failed clone must not leave its temp file behind.
+            assert sorted(os.listdir(tmp_path)) == ['a', 'b']
+            pytest.skip('no reflink support here')
+        raise
+    assert done == (True, 5000)
+    st = os.stat(duplicate)
+    assert inode(source) != inode(duplicate)
+    assert st.st_mode & 0o777 == 0o640
+    assert st.st_mtime_ns == 10 ** 18
+    assert read(duplicate) == b'x' * 5000
+    assert sorted(os.listdir(tmp_path)) == ['a', 'b']